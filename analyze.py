@@ -1,21 +1,39 @@
 import csv
-import gzip
-import sys
-from collections import Counter
+import multiprocessing
+import os
+from array import array
+from contextlib import nullcontext
+from collections import Counter, defaultdict, deque
+from itertools import chain, compress, islice
+from operator import neg
 from pathlib import Path
 from statistics import mean, median
 from typing import Iterable
 
-from utils.pattern import AlternatingPatternMatcher
-from utils.constants import TrainingDataColId, TIME_I, IS_DOWN_I, KEY_I, MAIN_AREA_KEYS, MOD_KEYS
-from utils.training_data import TrainingData
+from filter_and_convert_keystroke_dataset import iter_participant_events
+from utils.pattern import CompiledAlternatingPatternMatcher
+from utils.constants import TrainingDataColId, TIME_I, IS_DOWN_I, KEY_I
+from utils.keys import KeyTables, KeyVocabulary, add_to_chord, remove_from_chord, chord_key_ids, mask_key_ids, \
+    pair_code, pair_key_ids
+from utils.training_data import TrainingData, TrainingElements
 from utils.format import pct_row, pct, print_table, pct2_row, trim_trailing_zero, print_h1, print_h2, print_h3, print_h4
-from utils.serialization import TabMinDialect, read_from_csv_gz
+from utils.serialization import TabMinDialect, read_from_csv_gz, iter_batches_from_csv_gz, EventStore, \
+    is_event_store_of, write_training_events, EventStoreWriter, EventStoreView, TrainingEventsWriter, \
+    BlockGzipWriter
+from utils.summary import Summary, ExactSummary, QuantileSketch
 
 DATASET_PATH = Path(__file__).parent / 'dataset'
 
 LOG_PATH = DATASET_PATH / 'filtered_events.csv.gz'
+# written by the converter next to LOG_PATH, used instead of it if it was written together with it
+STORE_PATH = DATASET_PATH / 'filtered_events.columns'
+# otherwise, the mapped events of LOG_PATH are cached here (rebuilt when LOG_PATH changes)
+CACHE_PATH = DATASET_PATH / 'filtered_events.cache'
 TRAIN_PATH = DATASET_PATH / f'training_data.csv.gz'
+# the same as TRAIN_PATH as a packed array of TrainingEvent, which can be memory-mapped without parsing
+TRAIN_EVENTS_PATH = DATASET_PATH / 'training_data.bin'
+# written by the converter, so the cache uses the same key ids as STORE_PATH
+KEY_VOCABULARY_PATH = DATASET_PATH / 'key_vocabulary.json'
 
 PRINT_INDIVIDUAL = False
 DURATION_NUM_FMT = '_.0f'
@@ -25,92 +43,124 @@ MOD_VALUE = True
 
 KEYS_PERCENTAGE_BELOW = 0.99
 
-# does not include removals from key being pressed down consecutively
-event_after_this_one_was_removed = set()
+# Keep every duration to compute exact stats. Otherwise, a sketch with bounded memory per summary is used
+# (see QuantileSketch), which is exact for integer durations, but approximates the quantiles of the
+# overlap percentages.
+EXACT_STATS = False
 
+# Only presses with less time than this since the previous release are in "Time between previous release and
+# this press", as the typist likely paused otherwise.
+MAX_BETWEEN_DURATION = 1500
 
-def print_stats(numbers, fmt=DURATION_NUM_FMT):
-    if not numbers:
-        print("was empty\n")
-        return
+# If there is no event store of LOG_PATH, parse it once into an event store at CACHE_PATH, which can be analyzed
+# in parallel. Otherwise, LOG_PATH is analyzed directly in batches of whole participants (in a single process),
+# so only about LOG_BATCH_SIZE events are in memory at a time.
+CACHE_EVENTS = True
+LOG_BATCH_SIZE = 1 << 16
 
-    sorted_numbers = sorted(numbers)
-    most_below = perc_below(sorted_numbers)
+# Analyze the participants while the converter converts them in this process (see iter_participant_events),
+# instead of reading LOG_PATH, so it does not have to be written first. Gives the same result.
+CONVERT_IN_PROCESS = False
 
-    min_value = sorted_numbers[0]
-    max_value = sorted_numbers[-1]
-    count = len(sorted_numbers)
-    total_sum = sum(sorted_numbers)
-    avg = total_sum / count
+# Write the training data while the participants are analyzed, so it never is in memory as a whole.
+# Otherwise, it is collected and written at the end.
+STREAM_TRAINING_DATA = True
 
-    mid = count // 2
-    if count > 1 and count % 2 == 0:
-        median = (sorted_numbers[mid - 1] + sorted_numbers[mid]) / 2
-    else:
-        median = sorted_numbers[mid]
+# Number of processes that analyze the participants. 1 analyzes them in this process.
+NUM_WORKERS = os.cpu_count() or 1
+PARTICIPANTS_PER_TASK = 256
+# The intersections of the participants are collected in columns, and only added to the summaries per pair once
+# there are this many (or the analysis is flushed, see Analysis.flush)
+PENDING_INTERSECTIONS = 1 << 18
+
+
+def new_summary() -> Summary:
+    return ExactSummary() if EXACT_STATS else QuantileSketch()
+
+
+def merged_summary(summaries: Iterable[Summary]) -> Summary:
+    result = new_summary()
+    for summary in summaries:
+        result.merge(summary)
+    return result
+
+
+def print_stats(numbers, fmt=DURATION_NUM_FMT):
+    summary = numbers if isinstance(numbers, Summary) else ExactSummary(numbers)
+    if not summary:
+        print("was empty\n")
+        return
 
     num_below = trim_trailing_zero(KEYS_PERCENTAGE_BELOW * 100)
     print_table([
         ['min', 'max', 'avg', 'median', f'{num_below}% below'],
         None,
         [
-            f"{min_value:{fmt}}",
-            f"{max_value:{fmt}}",
-            f"{avg:{fmt}}",
-            f"{median:{fmt}}",
-            f"{most_below:{fmt}}",
+            f"{summary.min:{fmt}}",
+            f"{summary.max:{fmt}}",
+            f"{summary.mean:{fmt}}",
+            f"{summary.median():{fmt}}",
+            f"{summary.quantile(KEYS_PERCENTAGE_BELOW):{fmt}}",
         ]
     ])
     print()
 
 
-def perc_below(sorted_numbers):
-    i = len(sorted_numbers) * KEYS_PERCENTAGE_BELOW
-    rem = i - int(i)
-    j = int(i) + 1
-    if j >= len(sorted_numbers):
-        j = len(sorted_numbers) - 1
-    most_below = sorted_numbers[int(i)] * (1 - rem) + sorted_numbers[j] * rem
-    return most_below
+class IntersectionSummary:
+    def __init__(self):
+        self.overlap_durations = new_summary()
+        self.overlap_percentages = new_summary()
+        self.durations_between_both_pressed = new_summary()
 
+    def add(self, overlap_duration, overlap_percentage, duration_between_both_pressed):
+        self.overlap_durations.add(overlap_duration)
+        if overlap_percentage >= 0:
+            self.overlap_percentages.add(overlap_percentage)
+        self.durations_between_both_pressed.add(duration_between_both_pressed)
 
-def print_intersection_stats(intersections, kind):
-    all_overlap_durations = []
-    all_overlap_percentages = []
-    all_durations_between_both_pressed = []
+    def add_all(self, overlap_durations: array, overlap_percentages: array, durations_between_both_pressed: array):
+        self.overlap_durations.add_all(overlap_durations)
+        self.overlap_percentages.add_all(array('d', filter((0.0).__le__, overlap_percentages)))
+        self.durations_between_both_pressed.add_all(durations_between_both_pressed)
 
-    space_with_others_overlap_durations = []
-    space_duration_between_both_presses = []
+    def merge(self, other: 'IntersectionSummary'):
+        self.overlap_durations.merge(other.overlap_durations)
+        self.overlap_percentages.merge(other.overlap_percentages)
+        self.durations_between_both_pressed.merge(other.durations_between_both_pressed)
+        return self
 
-    for keys, overlap_data in intersections.items():
-        overlap_durations = []
-        overlap_percentages = []
-        durations_between_both_presses = []
-        for (overlap_duration, overlap_percentage, duration_between_both_pressed) in overlap_data:
-            overlap_durations.append(overlap_duration)
-            if overlap_percentage >= 0:
-                overlap_percentages.append(overlap_percentage)
-            durations_between_both_presses.append(duration_between_both_pressed)
 
+def print_intersection_stats(intersections: dict[int, IntersectionSummary], kind, keys: list[str]):
+    all_overlap_durations = new_summary()
+    all_overlap_percentages = new_summary()
+    all_durations_between_both_pressed = new_summary()
+
+    space_with_others_overlap_durations = new_summary()
+    space_duration_between_both_presses = new_summary()
+
+    for pair_id, summary in intersections.items():
+        # see IntersectionColumns
+        first_key_id, second_key_id = pair_key_ids(pair_id)
+        first_key = keys[first_key_id]
         if PRINT_INDIVIDUAL:
-            print_h3(f"{keys[0]} with {keys[1]}")
+            print_h3(f"{first_key} with {keys[second_key_id]}")
             print_h4("Overlap duration")
-            print_stats(overlap_durations)
-        all_overlap_durations.extend(overlap_durations)
+            print_stats(summary.overlap_durations)
+        all_overlap_durations.merge(summary.overlap_durations)
 
         if PRINT_INDIVIDUAL:
             print_h4("Overlap percentages")
-            print_stats(overlap_percentages, fmt='_.2%')
-        all_overlap_percentages.extend(overlap_percentages)
+            print_stats(summary.overlap_percentages, fmt='_.2%')
+        all_overlap_percentages.merge(summary.overlap_percentages)
 
         if PRINT_INDIVIDUAL:
             print_h4("Duration between both presses")
-            print_stats(durations_between_both_presses)
-        all_durations_between_both_pressed.extend(durations_between_both_presses)
+            print_stats(summary.durations_between_both_pressed)
+        all_durations_between_both_pressed.merge(summary.durations_between_both_pressed)
 
-        if keys[0] == "space":
-            space_with_others_overlap_durations.extend(overlap_durations)
-            space_duration_between_both_presses.extend(durations_between_both_presses)
+        if first_key == "space":
+            space_with_others_overlap_durations.merge(summary.overlap_durations)
+            space_duration_between_both_presses.merge(summary.durations_between_both_pressed)
 
     print_h3("Space THEN others")
     print_h4("Overlap duration")
@@ -130,44 +180,23 @@ def print_intersection_stats(intersections, kind):
     print_stats(all_durations_between_both_pressed)
 
 
-def load_events(path: Path):
-    return read_from_csv_gz(path, map_keys_and_remove_pause_marker)
+def cache_events(path: Path, cache_path: Path):
+    if not is_event_store_of(cache_path, path, with_hash=True):
+        print(f'Caching events of {path.name} in {cache_path.name}')
+        vocabulary = KeyVocabulary.load(KEY_VOCABULARY_PATH)
+        with EventStoreWriter(cache_path, source_path=path, hash_source=True, vocabulary=vocabulary) as writer:
+            read_from_csv_gz(path, lambda rows: write_mapped_keys(rows, writer))
+        if vocabulary.changed:
+            vocabulary.save(KEY_VOCABULARY_PATH)
 
 
-def map_keys_and_remove_pause_marker(
-        rows: Iterable[tuple[str, str, str]]
-) -> list[tuple[int, bool, str]]:
-    result = []
-    prev_row = None
-
+def write_mapped_keys(rows: Iterable[tuple[str, str, str]], writer: EventStoreWriter):
+    # must map the keys like analyze_csv
     for timestamp, is_down, key in rows:
         if key == '':
-            event_after_this_one_was_removed.add(prev_row)
-            continue
-
-        timestamp = int(timestamp)
-        is_down = is_down == '1'
-
-        if key is None:
-            # the , is likely incorrect, but we don't know the actual
-            # values because it was before the pynput vk change
-            # (from now on we will get an int instead of None instead)
-            key = ","
+            writer.writerow((int(timestamp), None, None))
         else:
-            if isinstance(key, int):
-                print("don't know what this is (skipping):", key, timestamp)
-                event_after_this_one_was_removed.add(prev_row)
-                continue
-
-            # this can boost performance by making string comparisons O(1) as only the identity is compared
-            # it also saves memory by not repeating same strings in memory
-            key = sys.intern(key.lower())
-
-        row = (timestamp, is_down, key)
-        result.append(row)
-        prev_row = row
-
-    return result
+            writer.writerow((int(timestamp), is_down == '1', key.lower()))
 
 
 def p_rows(counter: Counter, postfix=""):
@@ -233,30 +262,49 @@ def p_variations(key):
     ]
 
 
-def print_counter_as_table(counter, header, n_most_common):
+def print_counter_as_table(counter, header, n_most_common, name_of=None):
     l = [header, None]
     for k, v in counter.most_common(n_most_common):
-        l.append([k, v])
+        l.append([k if name_of is None else name_of(k), v])
     print_table(l)
 
 
-def collect_training_data(events, mod_counter: Counter):
-    result = TrainingData([])
+# a = some key we don't care about that is down before p (to not exclude overlaps with p)
+# p = previous, x = tap (or) hold key, n = next key (after tap hold)
+# z = after x and n, another key will be pressed
+TRAINING_DATA_MATCHER = CompiledAlternatingPatternMatcher('ApAPAxPnzXzNzXz', down_index=IS_DOWN_I, key_index=KEY_I)
+# Number of events after a participant block that collect_training_data needs
+TRAINING_DATA_LOOKAHEAD = TRAINING_DATA_MATCHER.match_length
+
 
-    # a = some key we don't care about that is down before p (to not exclude overlaps with p)
-    # p = previous, x = tap (or) hold key, n = next key (after tap hold)
-    # z = after x and n, another key will be pressed
-    pattern = 'ApAPAxPnzXzNzXz'
+def collect_training_data(events, count, tables: KeyTables, mod_counter: Counter, start_index=0):
+    """
+    Collects the training samples of the first count events, which are the block of one participant.
+    The keys of the events are key ids of tables.keys, and mod_counter counts the key ids.
+
+    The matcher runs over all participants as one stream: a match may start in the block and end in the next one.
+    Such a match is no sample (the pause marker between them was removed), but matching still continues after it.
+    So events must also contain the (up to) TRAINING_DATA_LOOKAHEAD events after the block, and start_index is
+    where matching continues in the block. Returns the training data and where it continues in the next block.
+    """
+    result = TrainingData()
 
     # make sure this is consistent with TrainingDataColId and InputTrainCol
     order = 'pPxnNXz'
 
-    matcher = AlternatingPatternMatcher(pattern, down_index=IS_DOWN_I, key_index=KEY_I)
-    for match in matcher.all_matches(events, continue_at_letter='x'):
+    is_mod_key = tables.is_mod
+    is_main_area_key = tables.is_main_area
+
+    next_start = start_index
+    for match in TRAINING_DATA_MATCHER.all_matches(events, start_index, continue_at_letter='x'):
+        next_start = match['x']
+        if max(match.values()) >= count:
+            continue
+
         th_down = events[match['x']]
 
-        is_mod = th_down[KEY_I] in MOD_KEYS
-        is_next_main = events[match['n']][KEY_I] in MAIN_AREA_KEYS
+        is_mod = is_mod_key[th_down[KEY_I]]
+        is_next_main = is_main_area_key[events[match['n']][KEY_I]]
         if is_mod and not is_next_main:
             continue
 
@@ -265,18 +313,13 @@ def collect_training_data(events, mod_counter: Counter):
         if (next_up[TIME_I] - th_down[TIME_I]) > 9000:
             continue
 
-        last = max(match.values())
-        all_but_last = (events[j] for j in match.values() if j != last)
-        if any(e in event_after_this_one_was_removed for e in all_but_last):
-            continue
-
         prev = events[match['p']]
-        prev_is_mod = prev[KEY_I] in MOD_KEYS
+        prev_is_mod = is_mod_key[prev[KEY_I]]
 
         r = [events[match[o]][TIME_I] for o in order]
         r.append(prev_is_mod)
         r.append(is_mod)
-        result.elements.append(tuple(r))
+        result.elements.append(r)
 
         is_triple_down = match['n'] + 1 == match['z']
         is_wrapped = match['N'] < match['X']
@@ -284,7 +327,7 @@ def collect_training_data(events, mod_counter: Counter):
         if is_mod:
             mod_counter[th_down[KEY_I]] += 1
 
-    return result
+    return result, max(next_start - count, 0)
 
 
 def find_prev_event(events, start_index, key_to_find, key_to_find_down, max_search_window=7):
@@ -297,147 +340,595 @@ def find_prev_event(events, start_index, key_to_find, key_to_find_down, max_sear
                 break
 
 
+def write_csv_rows_of_training_data(writer, elements: TrainingElements):
+    for el in elements:
+        # The last element is a boolean, so make it an int.
+        writer.writerow((col.to_csv(el[col.value]) for col in TrainingDataColId))
+
+
 def write_csv_of_training_data(training_data: TrainingData):
-    with gzip.open(str(TRAIN_PATH), 'wt', newline='', encoding='utf-8') as gz_file:
+    with BlockGzipWriter(TRAIN_PATH, replace=True) as gz_file:
         writer = csv.writer(gz_file, dialect=TabMinDialect)
 
         writer.writerow(TrainingDataColId.member_names)
-        for el in training_data.elements:
-            # The last element is a boolean, so make it an int.
-            writer.writerow((col.to_csv(el[col.value]) for col in TrainingDataColId))
+        write_csv_rows_of_training_data(writer, training_data.elements)
 
     print(f'Written training data to {TRAIN_PATH}')
 
 
-if __name__ == '__main__':
-    print('All durations are milliseconds.')
-    print()
-    print(f'Loading events from {LOG_PATH.name}')
-    print()
-    events = load_events(LOG_PATH)
-    print(f"Loaded {len(events):_} events")
+def write_binary_training_data(training_data: TrainingData):
+    write_training_events(TRAIN_EVENTS_PATH, training_data.elements, replace=True)
+    print(f'Written training data to {TRAIN_EVENTS_PATH}')
+
+
+class TrainingDataWriter:
+    """
+    Writes training samples to TRAIN_PATH and TRAIN_EVENTS_PATH as they come in (see Analysis.training_sink),
+    so they do not have to be kept in memory. Both files are buffered and written in batches.
+    They are written next to their paths first, and only replace the previous files when the writer is closed
+    after the analysis was completed.
+    """
+    def __init__(self):
+        self.gz_file = BlockGzipWriter(TRAIN_PATH, replace=True)
+        self.csv_writer = csv.writer(self.gz_file, dialect=TabMinDialect)
+        self.csv_writer.writerow(TrainingDataColId.member_names)
+        self.events_writer = TrainingEventsWriter(TRAIN_EVENTS_PATH, replace=True)
+
+    def write(self, elements: TrainingElements):
+        write_csv_rows_of_training_data(self.csv_writer, elements)
+        self.events_writer.write(elements)
+
+    def close(self, completed=True):
+        self.events_writer.close(write_header=completed)
+        self.gz_file.close(write_index=completed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(completed=exc_type is None)
+
+
+class IntersectionColumns:
+    """
+    The pairs of presses that were down at the same time (see sweep_intersections) as columns.
+
+    A pair id is pair_code(first_key_id, second_key_id). For a wrap, the first key is the wrapping one
+    (e.g. Shift down, A down, A up, Shift up), otherwise it is the key that was released first.
+    The overlap percentage is -1 if the key released first was held down for 0 ms.
+    """
+    def __init__(self):
+        self.pair_ids = array('q')
+        self.is_wrap = array('B')
+        self.overlap_durations = array('q')
+        self.overlap_percentages = array('d')
+        self.durations_between_both_pressed = array('q')
+        # (key id, timestamp) of the keys that were held down for 0 ms while another was down
+        self.zero_durations = []
+
+    def __len__(self):
+        return len(self.pair_ids)
+
+    def grouped(self):
+        """
+        Yields (pair id, overlap durations, overlap percentages, durations between both pressed) of each pair id,
+        in the order of its first pair. The columns are reordered by pair id once, and each pair id gets
+        slices of them, so there is no Python object per pair.
+        """
+        pair_ids = self.pair_ids
+        # stable, so the first index of each pair id comes first
+        order = sorted(range(len(pair_ids)), key=pair_ids.__getitem__)
+        durations = array('q', map(self.overlap_durations.__getitem__, order))
+        percentages = array('d', map(self.overlap_percentages.__getitem__, order))
+        betweens = array('q', map(self.durations_between_both_pressed.__getitem__, order))
+
+        groups = []
+        start = 0
+        for pair_id, count in sorted(Counter(pair_ids).items()):
+            groups.append((order[start], pair_id, start, start + count))
+            start += count
+        groups.sort()
+
+        for _, pair_id, start, end in groups:
+            yield pair_id, durations[start:end], percentages[start:end], betweens[start:end]
+
+
+def sweep_intersections(times, downs, key_ids, result: IntersectionColumns = None) -> IntersectionColumns:
+    """
+    Sweeps over the events (in time order) of one participant block and, at each release, pairs the released key
+    with every key that is still down. The pairs are appended to result, if given.
+    """
+    if result is None:
+        result = IntersectionColumns()
+    pair_ids = result.pair_ids
+    is_wrap = result.is_wrap
+    overlap_durations = result.overlap_durations
+    overlap_percentages = result.overlap_percentages
+    durations_between_both_pressed = result.durations_between_both_pressed
 
-    key_durations = {}
-    zero_overlap_durations = {MOD_VALUE: [], NON_MOD_VALUE: []}
-    mod_intersections = {}
-    non_mod_intersections = {}
     down = {}
+    for timestamp, is_pressed, key in zip(times, downs, key_ids):
+        if is_pressed:
+            down[key] = timestamp
+            continue
 
-    duration_between_previous_release_and_this_press = {}
-    last_release_key = None
-    last_release_timestamp = None
+        released_at = timestamp
+        when_down = down.pop(key)
+        dur = released_at - when_down
+        if dur == 0 and down:
+            result.zero_durations.extend((key, released_at) for _ in down)
+
+        for other_key, other_when_down in down.items():
+            if other_when_down < when_down:
+                # the other key was down before this one, and it isn't released yet,
+                # so it completely wraps this one (e.g. Shift down, A down, A up, Shift up)
+                overlap_duration = dur
+                pair_ids.append(pair_code(other_key, key))
+                is_wrap.append(1)
+            else:
+                # the other key was down after this one (e.g. Shift down, A down, Shift up, A up)
+                # Since this key (Shift in the example) will already be up, when the other key (A)
+                # is up, it would not be registered, if we only consider if the other key is mod
+                overlap_duration = released_at - other_when_down
+                pair_ids.append(pair_code(key, other_key))
+                is_wrap.append(0)
 
-    total_counts = Counter()
-    zero_overlap_counts = Counter()
+            overlap_durations.append(overlap_duration)
+            # the duration the just-now-released key is held down with a not-yet-released key
+            # divided by the total duration this key was held down
+            overlap_percentages.append(-1 if dur == 0 else 100 * (overlap_duration / dur))
+            durations_between_both_pressed.append(abs(other_when_down - when_down))
 
-    overlap_counts = Counter()
-    wrap_counts = Counter()  # e.g. Shift down, A down, A up, Shift up
+    return result
 
-    mods_simultaneous_counts = Counter()
-    simultaneous_counts = Counter()
-    key_counts = Counter()
-    mods_down = set()
 
-    wrapped_durations_press_and_next_press = []
+class Analysis:
+    """
+    All statistics and the training data of some participants.
+
+    Participant blocks are independent of each other, so they can be analyzed separately (e.g. in different
+    processes) and then merged. Merging the results in participant order gives exactly the same report
+    as analyzing all participants one after the other. The only exception is where the training data matcher
+    continues in the next block (training_data_offset), which analyze_all checks when merging.
+
+    The events have key ids (see KeyTables), and all counters are keyed by them. The held down keys are tracked
+    as a chord code (the key ids in press order, see add_to_chord) and a bitmask of the held down mods, so
+    simultaneous_counts is keyed by chord codes and mods_simultaneous_counts by bitmasks. Only the printed
+    ones are turned into keys (see key_name, chord_name and mask_name).
+
+    If training_sink is given, the training samples are written to it (see TrainingDataWriter) as soon as
+    they are collected or merged, and only the counters are kept in training_data.
+
+    The intersections are collected in pending_intersections and added to the counters and summaries per pair
+    in bulk (see flush), which must be called before the results are read.
+    """
+    def __init__(self, tables: KeyTables, training_sink: TrainingDataWriter = None):
+        self.tables = tables
+        self.training_sink = training_sink
+
+        self.key_durations = defaultdict(new_summary)
+        self.zero_overlap_durations = {MOD_VALUE: new_summary(), NON_MOD_VALUE: new_summary()}
+        self.mod_intersections = defaultdict(IntersectionSummary)
+        self.non_mod_intersections = defaultdict(IntersectionSummary)
+
+        self.duration_between_previous_release_and_this_press = defaultdict(new_summary)
+
+        self.total_counts = Counter()
+        self.zero_overlap_counts = Counter()
+
+        self.overlap_counts = Counter()
+        self.wrap_counts = Counter()  # e.g. Shift down, A down, A up, Shift up
+
+        self.mods_simultaneous_counts = Counter()
+        self.simultaneous_counts = Counter()
+        self.key_counts = Counter()
+
+        self.wrapped_durations_press_and_next_press = new_summary()
+        self.pending_intersections = IntersectionColumns()
+
+        self.training_data = TrainingData()
+        self.mod_training_data_counter = Counter()
+        # where the training data matcher continues in the next participant block (see collect_training_data)
+        self.training_data_offset = 0
+
+        # keys that were still down at the end of a participant block
+        self.not_released = {}
+        self.num_events = 0
+
+    def add_participant(self, events, count, first_index=0):
+        """
+        Analyzes the first count events, which are the block of one participant.
+        The (up to) TRAINING_DATA_LOOKAHEAD events after the block must be passed as well, as the training data
+        matcher runs across participants (see collect_training_data).
+        first_index is the index of the first event in the whole stream (only used for error messages).
+        """
+        self.num_events += count
+        keys = self.tables.keys
+        is_mod_key = self.tables.is_mod
+        shift = self.tables.id_of('shift')
+        shift_bit = 0 if shift is None else 1 << shift
+
+        down = {}
+        last_release_key = None
+        last_release_timestamp = None
+        chord = 0
+        down_mask = 0
+        mods_mask = 0
+
+        for i, (timestamp, is_pressed, key) in enumerate(events[:count], first_index):
+            if is_pressed:
+                if key in down:
+                    raise ValueError(f'event {i}: key {keys[key]} pressed at {timestamp} but already down - '
+                                     f'down: {self._named(down)}')
+
+                down[key] = timestamp
+                key_bit = 1 << key
+                chord = add_to_chord(chord, key)
+                down_mask |= key_bit
+                is_mod = is_mod_key[key]
+                self.total_counts[is_mod] += 1
+
+                self.key_counts[key] += 1
+                if is_mod:
+                    mods_mask |= key_bit
+                elif (len(down) > 2 or not down_mask & shift_bit) and mods_mask:
+                    # mods are pressed right now, but this is not one
+                    # ignoring mods only overlapping mods here (same for non-mods)
+                    self.simultaneous_counts[chord] += 1
+            else:
+                # Key is released
+                when_down = down.get(key)
+                if when_down is None:
+                    raise ValueError(f'event {i}: key {keys[key]} released at {timestamp} but not pressed - '
+                                     f'down: {self._named(down)}')
+
+                num_pressed_after = 0
+                for other_key in reversed(down):
+                    if other_key == key:
+                        break
+                    num_pressed_after += 1
+                chord = remove_from_chord(chord, num_pressed_after)
+
+                del down[key]
+                dur = timestamp - when_down
+
+                if last_release_key is not None:
+                    between_dur = when_down - last_release_timestamp
+                    # negative value mean that the previous key was released after this one was pressed down
+                    if 0 <= between_dur < MAX_BETWEEN_DURATION:
+                        self.duration_between_previous_release_and_this_press[key].add(between_dur)
+                last_release_key = key
+                last_release_timestamp = timestamp
+
+                self.key_durations[key].add(dur)
+
+                if not down and events[i - first_index - 1][KEY_I] == key and events[i - first_index - 1][IS_DOWN_I]:
+                    is_mod = is_mod_key[key]
+                    self.zero_overlap_counts[is_mod] += 1
+                    self.zero_overlap_durations[is_mod].add(dur)
+
+                key_bit = 1 << key
+                down_mask ^= key_bit
+                if mods_mask & key_bit:
+                    if mods_mask & (mods_mask - 1):
+                        # more than one mod is down
+                        self.mods_simultaneous_counts[mods_mask] += 1
+                    mods_mask ^= key_bit
+
+        self.not_released.update(self._named(down))
+
+        if count:
+            self.add_intersections(*zip(*events[:count]))
+
+        training_data, self.training_data_offset = collect_training_data(
+            events, count, self.tables, self.mod_training_data_counter, self.training_data_offset)
+        self._add_training_data(training_data)
+
+    def _add_training_data(self, training_data: TrainingData):
+        self.training_data.merge(training_data)
+        if self.training_sink is not None:
+            self.training_sink.write(self.training_data.take_elements())
+
+    def add_intersections(self, times, downs, key_ids):
+        pending = self.pending_intersections
+        num_pending = len(pending)
+        sweep_intersections(times, downs, key_ids, pending)
+
+        keys = self.tables.keys
+        for key_id, timestamp in pending.zero_durations:
+            print(f'{keys[key_id]} from {timestamp} to {timestamp} was pressed for 0 ms')
+        pending.zero_durations.clear()
+
+        if num_pending < PENDING_INTERSECTIONS <= len(pending):
+            self.flush()
+
+    def flush(self):
+        """
+        Adds the pending intersections to the counters and summaries, with one bulk update per pair.
+        """
+        pending = self.pending_intersections
+        if not pending:
+            return
+        self.pending_intersections = IntersectionColumns()
+        is_mod_key = self.tables.is_mod
+
+        for (pair_id, is_wrap), count in Counter(zip(pending.pair_ids, pending.is_wrap)).items():
+            first_key, second_key = pair_key_ids(pair_id)
+            counts = self.wrap_counts if is_wrap else self.overlap_counts
+            counts[(is_mod_key[first_key], is_mod_key[second_key])] += count
+
+        # the wrapping key was pressed first
+        self.wrapped_durations_press_and_next_press.add_all(
+            array('q', compress(map(neg, pending.durations_between_both_pressed), pending.is_wrap)))
+
+        for pair_id, durations, percentages, betweens in pending.grouped():
+            first_key, second_key = pair_key_ids(pair_id)
+            is_mod = is_mod_key[first_key] or is_mod_key[second_key]
+            intersections = self.mod_intersections if is_mod else self.non_mod_intersections
+            intersections[pair_id].add_all(durations, percentages, betweens)
+
+    def _named(self, key_id_to_value: dict) -> dict:
+        keys = self.tables.keys
+        return {keys[key_id]: value for key_id, value in key_id_to_value.items()}
+
+    def key_name(self, key_id: int) -> str:
+        return self.tables.keys[key_id]
+
+    def chord_name(self, chord: int) -> str:
+        # in press order
+        return " ".join(self.key_name(key_id) for key_id in chord_key_ids(chord))
+
+    def mask_name(self, mask: int) -> str:
+        return " ".join(sorted(self.key_name(key_id) for key_id in mask_key_ids(mask)))
+
+    def merge(self, other: 'Analysis'):
+        self.flush()
+        other.flush()
+        for key, summary in other.key_durations.items():
+            self.key_durations[key].merge(summary)
+        for is_mod, summary in other.zero_overlap_durations.items():
+            self.zero_overlap_durations[is_mod].merge(summary)
+        for keys, summary in other.mod_intersections.items():
+            self.mod_intersections[keys].merge(summary)
+        for keys, summary in other.non_mod_intersections.items():
+            self.non_mod_intersections[keys].merge(summary)
+        for key, summary in other.duration_between_previous_release_and_this_press.items():
+            self.duration_between_previous_release_and_this_press[key].merge(summary)
+
+        for counter_name in ('total_counts', 'zero_overlap_counts', 'overlap_counts', 'wrap_counts',
+                             'mods_simultaneous_counts', 'simultaneous_counts', 'key_counts',
+                             'mod_training_data_counter'):
+            getattr(self, counter_name).update(getattr(other, counter_name))
+
+        self.wrapped_durations_press_and_next_press.merge(other.wrapped_durations_press_and_next_press)
+        self._add_training_data(other.training_data)
+        self.training_data_offset = other.training_data_offset
+        self.not_released.update(other.not_released)
+        self.num_events += other.num_events
+        return self
+
+
+def participant_blocks(events: EventStoreView) -> list[tuple[int, int]]:
+    """
+    The (start, end) indexes of each participant's events, which are separated by the pause markers.
+    """
+    blocks = []
+    start = 0
+    for last in events.indexes_before_pause_markers():
+        if last is not None and last >= start:
+            blocks.append((start, last + 1))
+            start = last + 1
+    if start < len(events):
+        blocks.append((start, len(events)))
+    return blocks
+
+
+def participants_of_rows(rows: Iterable[list[str]]) -> Iterable[list[list[str]]]:
+    """
+    Splits CSV rows of LOG_PATH at the pause markers.
+    """
+    participant = []
+    for row in rows:
+        if row[KEY_I] == '':
+            if participant:
+                yield participant
+                participant = []
+        else:
+            participant.append(row)
+    if participant:
+        yield participant
+
+
+def analyze_csv(path: Path, vocabulary: KeyVocabulary, training_sink: TrainingDataWriter = None) -> Analysis:
+    """
+    Analyzes the participants of path (the CSV written by the converter) while reading it in batches of
+    whole participants (see iter_batches_from_csv_gz), so neither an event store nor all events are needed.
+    The keys are mapped like in write_mapped_keys. Gives the same result as analyze_all.
+    """
+    participants = ([(int(t), is_down == '1', vocabulary.id_of(key.lower())) for t, is_down, key in rows]
+                    for batch in iter_batches_from_csv_gz(path, LOG_BATCH_SIZE, split_at_pause_markers=True)
+                    for rows in participants_of_rows(batch))
+    return analyze_streamed(participants, KeyTables(vocabulary.keys), training_sink)
+
+
+def analyze_converted(vocabulary: KeyVocabulary, training_sink: TrainingDataWriter = None) -> Analysis:
+    """
+    Analyzes the participants as the converter yields them (see iter_participant_events), with the same result
+    as analyze_csv of what the converter would have written.
+    """
+    participants = ([(t, down == 1, vocabulary.id_of(key.lower())) for t, down, key in rows]
+                    for _, rows in iter_participant_events())
+    return analyze_streamed(participants, KeyTables(vocabulary.keys), training_sink)
+
+
+def with_lookahead(participants: Iterable[list], num_events: int):
+    """
+    Yields the events of each participant followed by the (up to) num_events events after them,
+    and the number of events of the participant.
+    """
+    pending = deque()
+    num_pending_events = 0
+
+    def take_first():
+        nonlocal num_pending_events
+        events = pending.popleft()
+        num_pending_events -= len(events)
+        return events + list(islice(chain.from_iterable(pending), num_events)), len(events)
+
+    for events in participants:
+        pending.append(events)
+        num_pending_events += len(events)
+        while num_pending_events - len(pending[0]) >= num_events:
+            yield take_first()
+
+    while pending:
+        yield take_first()
+
+
+def analyze_streamed(participants: Iterable[list], tables: KeyTables, training_sink: TrainingDataWriter = None):
+    """
+    Analyzes the (timestamp, down, key id) events of each participant as they come, in participant order.
+    The key ids may be new keys of tables.keys, as the tables are updated for each participant.
+    """
+    analysis = Analysis(tables, training_sink)
+
+    # a participant is analyzed once the events after it are known (see Analysis.add_participant)
+    first_index = 0
+    for events, count in with_lookahead(participants, TRAINING_DATA_LOOKAHEAD):
+        tables.update()
+        analysis.add_participant(events, count, first_index)
+        first_index += count
+    analysis.flush()
+    return analysis
+
+
+def analyze_participants(events, blocks, tables: KeyTables, training_data_offset=0) -> Analysis:
+    analysis = Analysis(tables)
+    analysis.training_data_offset = training_data_offset
+    for start, end in blocks:
+        # with the events after the block (see Analysis.add_participant)
+        analysis.add_participant(events[start:end + TRAINING_DATA_LOOKAHEAD], end - start, start)
+    analysis.flush()
+    return analysis
+
+
+def analyze_participants_in_worker(store_path_and_blocks) -> tuple[Analysis, Analysis]:
+    """
+    Analyzes the first participant block and the other blocks separately, as the training data matcher may
+    not continue at the first event of the blocks like the worker assumes (see analyze_all).
+    """
+    store_path, blocks = store_path_and_blocks
+    with EventStore(store_path) as store:
+        events = store.without_pause_markers(with_key_ids=True)
+        tables = KeyTables(store.keys)
+        first = analyze_participants(events, blocks[:1], tables)
+        return first, analyze_participants(events, blocks[1:], tables, first.training_data_offset)
+
+
+def analyze_all(store_path: Path, num_workers, training_sink: TrainingDataWriter = None) -> Analysis:
+    """
+    Analyzes the participants in chunks of PARTICIPANTS_PER_TASK and merges the results in participant order.
+    With more than one worker, the chunks are analyzed in a process pool, where each worker memory-maps
+    the event store itself. The serial path uses the same chunks, so both give the same result.
+    With a training_sink, the training samples of each chunk are written to it when it is merged.
+
+    A worker does not know where the training data matcher continues in its chunk, as that depends on the
+    chunks before it. It assumes the first event, and the first block is analyzed again if that was wrong.
+    Only if the matcher then continues elsewhere after the first block, the other blocks are analyzed again, too.
+    """
+    with EventStore(store_path) as store:
+        events = store.without_pause_markers(with_key_ids=True)
+        blocks = participant_blocks(events)
+        chunks = [blocks[i:i + PARTICIPANTS_PER_TASK] for i in range(0, len(blocks), PARTICIPANTS_PER_TASK)]
+
+        tables = KeyTables(store.keys)
+        result = Analysis(tables, training_sink)
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers) as pool:
+                jobs = [(store_path, chunk) for chunk in chunks]
+                for chunk, (first, rest) in zip(chunks, pool.imap(analyze_participants_in_worker, jobs)):
+                    if result.training_data_offset:
+                        offset_after_first = first.training_data_offset
+                        first = analyze_participants(events, chunk[:1], tables, result.training_data_offset)
+                        if first.training_data_offset != offset_after_first:
+                            rest = analyze_participants(events, chunk[1:], tables, first.training_data_offset)
+                    result.merge(first)
+                    result.merge(rest)
+        else:
+            for chunk in chunks:
+                result.merge(analyze_participants(events, chunk, tables, result.training_data_offset))
 
-    for i, (timestamp, is_pressed, key) in enumerate(events):
-        if is_pressed:
-            if key in down:
-                raise ValueError(f'event {i}: key {key} pressed at {timestamp} but already down - down: {down}')
+    return result
 
-            down[key] = timestamp
-            total_counts[key in MOD_KEYS] += 1
-
-            key_counts[key] += 1
-            if key in MOD_KEYS:
-                mods_down.add(key)
-            elif (len(down) > 2 or 'shift' not in down) and not down.keys().isdisjoint(MOD_KEYS):
-                # mods are pressed right now, but this is not one
-                # ignoring mods only overlapping mods here (same for non-mods)
-                simultaneous_counts[" ".join(down.keys())] += 1
+
+if __name__ == '__main__':
+    print('All durations are milliseconds.')
+    print()
+    if CONVERT_IN_PROCESS:
+        events_store_path = None
+        print('Analyzing events while converting the participant files')
+        print()
+    elif is_event_store_of(STORE_PATH, LOG_PATH):
+        events_store_path = STORE_PATH
+        print(f'Loading events from {STORE_PATH.name}')
+        print()
+    elif CACHE_EVENTS:
+        events_store_path = CACHE_PATH
+        print(f'Loading events from {LOG_PATH.name}')
+        print()
+        cache_events(LOG_PATH, CACHE_PATH)
+    else:
+        events_store_path = None
+        print(f'Analyzing events of {LOG_PATH.name} in batches')
+        print()
+
+    if events_store_path is not None:
+        with EventStore(events_store_path) as store:
+            print(f"Loaded {len(store.without_pause_markers()):_} events")
+
+    with TrainingDataWriter() if STREAM_TRAINING_DATA else nullcontext() as training_data_writer:
+        if CONVERT_IN_PROCESS:
+            ANALYSIS = analyze_converted(KeyVocabulary.load(KEY_VOCABULARY_PATH), training_data_writer)
+            print(f"Loaded {ANALYSIS.num_events:_} events")
+        elif events_store_path is None:
+            ANALYSIS = analyze_csv(LOG_PATH, KeyVocabulary.load(KEY_VOCABULARY_PATH), training_data_writer)
+            print(f"Loaded {ANALYSIS.num_events:_} events")
         else:
-            # Key is released
-            when_down = down.get(key)
-            if when_down is None:
-                raise ValueError(f'event {i}: key {key} released at {timestamp} but not pressed - down: {down}')
-
-            del down[key]
-            if key in mods_down:
-                if len(mods_down) > 1:
-                    mods_simultaneous_counts[" ".join(sorted(mods_down))] += 1
-                mods_down.remove(key)
-
-            released_at = timestamp
-            dur = released_at - when_down
-
-            if last_release_key is not None:
-                between_dur = when_down - last_release_timestamp
-                # negative value mean that the previous key was released after this one was pressed down
-                if 0 <= between_dur < 1500:
-                    duration_between_previous_release_and_this_press.setdefault(key, []).append(between_dur)
-            last_release_key = key
-            last_release_timestamp = timestamp
-
-            key_durations.setdefault(key, []).append(dur)
-            is_mod = key in MOD_KEYS
-
-            if not down and events[i - 1][KEY_I] == key and events[i - 1][IS_DOWN_I]:
-                zero_overlap_counts[is_mod] += 1
-                zero_overlap_durations[is_mod].append(dur)
-
-            for other_key, other_when_down in down.items():
-                other_is_mod = other_key in MOD_KEYS
-
-                if other_when_down < when_down:
-                    # the other key was down before this one, and it isn't released yet,
-                    # so it completely wraps this one (e.g. Shift down, A down, A up, Shift up)
-                    overlap_duration = dur
-                    intersect_key = (other_key, key)
-
-                    wrap_counts[(other_is_mod, is_mod)] += 1
-                    wrapped_durations_press_and_next_press.append(
-                        other_when_down - when_down)
-                else:
-                    # the other key was down after this one (e.g. Shift down, A down, Shift up, A up)
-                    # Since this key (Shift in the example) will already be up, when the other key (A)
-                    # is up, it would not be registered, if we only consider if the other key is mod
-                    overlap_duration = released_at - other_when_down
-                    intersect_key = (key, other_key)
-
-                    overlap_counts[(is_mod, other_is_mod)] += 1
-
-                overlap_percentage = -1
-                if dur == 0:
-                    print(f'{key} from {when_down} to {released_at} was pressed for 0 ms')
-                else:
-                    # the duration the just-now-released key is held down with a not-yet-released key
-                    # divided by the total duration this key was held down
-                    overlap_percentage = 100 * (overlap_duration / dur)
-
-                duration_between_both_pressed = abs(other_when_down - when_down)
-
-                intersections = mod_intersections if is_mod or other_is_mod else non_mod_intersections
-                intersections.setdefault(intersect_key, []).append(
-                    (overlap_duration, overlap_percentage, duration_between_both_pressed))
-
-    if down:
-        print(f"Somehow pressed_keys is not empty: {down}")
+            ANALYSIS = analyze_all(events_store_path, NUM_WORKERS, training_data_writer)
+    key_durations = ANALYSIS.key_durations
+    zero_overlap_durations = ANALYSIS.zero_overlap_durations
+    mod_intersections = ANALYSIS.mod_intersections
+    non_mod_intersections = ANALYSIS.non_mod_intersections
+    duration_between_previous_release_and_this_press = ANALYSIS.duration_between_previous_release_and_this_press
+    total_counts = ANALYSIS.total_counts
+    zero_overlap_counts = ANALYSIS.zero_overlap_counts
+    overlap_counts = ANALYSIS.overlap_counts
+    wrap_counts = ANALYSIS.wrap_counts
+    mods_simultaneous_counts = ANALYSIS.mods_simultaneous_counts
+    simultaneous_counts = ANALYSIS.simultaneous_counts
+    key_counts = ANALYSIS.key_counts
+    KEYS = ANALYSIS.tables.keys
+    IS_MOD_KEY = ANALYSIS.tables.is_mod
+    wrapped_durations_press_and_next_press = ANALYSIS.wrapped_durations_press_and_next_press
+
+    if ANALYSIS.not_released:
+        print(f"Somehow pressed_keys is not empty: {ANALYSIS.not_released}")
     print()
     print()
 
     print_h1('Counts per key')
-    print_counter_as_table(key_counts, ["key", "count"], 50)
+    print_counter_as_table(key_counts, ["key", "count"], 50, ANALYSIS.key_name)
     print()
     print_h1('Simultaneous counts')
-    print_counter_as_table(simultaneous_counts, ["key", "count"], 50)
+    print_counter_as_table(simultaneous_counts, ["key", "count"], 50, ANALYSIS.chord_name)
     print()
     print_h1('Simultaneous mods counts')
-    print_counter_as_table(mods_simultaneous_counts, ["key", "count"], 50)
+    print_counter_as_table(mods_simultaneous_counts, ["key", "count"], 50, ANALYSIS.mask_name)
     print()
 
-    all_durations = []
-    mod_durations = []
-    non_mod_durations = []
+    all_durations = new_summary()
+    mod_durations = new_summary()
+    non_mod_durations = new_summary()
 
     print_h1("Durations")
     if PRINT_INDIVIDUAL:
@@ -445,11 +936,11 @@ if __name__ == '__main__':
 
     for key, durations in key_durations.items():
         if PRINT_INDIVIDUAL:
-            print_h3(f"Key '{key}'")
+            print_h3(f"Key '{KEYS[key]}'")
             print_stats(durations)
-        all_durations.extend(durations)
-        d = mod_durations if key in MOD_KEYS else non_mod_durations
-        d.extend(durations)
+        all_durations.merge(durations)
+        d = mod_durations if IS_MOD_KEY[key] else non_mod_durations
+        d.merge(durations)
 
     print_h2("All keys")
     print_stats(all_durations)
@@ -461,7 +952,7 @@ if __name__ == '__main__':
     print_stats(zero_overlap_durations[NON_MOD_VALUE])
 
     print_h3("Overlap")
-    print_stats(sum((v for k, v in key_durations.items() if k not in MOD_KEYS), start=[]))
+    print_stats(merged_summary(v for k, v in key_durations.items() if not IS_MOD_KEY[k]))
 
     print_h2("Mods")
     print_stats(mod_durations)
@@ -470,11 +961,11 @@ if __name__ == '__main__':
     print_stats(zero_overlap_durations[MOD_VALUE])
 
     print_h3("Overlap")
-    print_stats(sum((v for k, v in key_durations.items() if k in MOD_KEYS), start=[]))
+    print_stats(merged_summary(v for k, v in key_durations.items() if IS_MOD_KEY[k]))
 
-    all_between_durations = []
-    mod_between_durations = []
-    non_mod_between_durations = []
+    all_between_durations = new_summary()
+    mod_between_durations = new_summary()
+    non_mod_between_durations = new_summary()
 
     print()
     print_h1("Time between previous release and this press (no overlap)")
@@ -483,12 +974,12 @@ if __name__ == '__main__':
 
     for key, durations in duration_between_previous_release_and_this_press.items():
         if PRINT_INDIVIDUAL:
-            print_h3(f"Key '{key}'")
+            print_h3(f"Key '{KEYS[key]}'")
             print_stats(durations)
 
-        all_between_durations.extend(durations)
-        d = mod_between_durations if key in MOD_KEYS else non_mod_between_durations
-        d.extend(durations)
+        all_between_durations.merge(durations)
+        d = mod_between_durations if IS_MOD_KEY[key] else non_mod_between_durations
+        d.merge(durations)
 
     print_h2("All keys")
     print_stats(all_between_durations)
@@ -502,10 +993,10 @@ if __name__ == '__main__':
     print()
     print_h1("Intersections")
     print_h2("Non-mods")
-    print_intersection_stats(non_mod_intersections, 'non-mods')
+    print_intersection_stats(non_mod_intersections, 'non-mods', KEYS)
 
     print_h2("Mods")
-    print_intersection_stats(mod_intersections, 'mods')
+    print_intersection_stats(mod_intersections, 'mods', KEYS)
 
     print_h4("Duration between presses (only wrapped)")
     print_stats(wrapped_durations_press_and_next_press)
@@ -563,9 +1054,8 @@ if __name__ == '__main__':
     print_table(p_variations(MOD_VALUE))
     print()
 
-    mod_training_data_counter = Counter()
-
-    TRAINING_DATA = collect_training_data(events, mod_training_data_counter)
+    mod_training_data_counter = ANALYSIS.mod_training_data_counter
+    TRAINING_DATA = ANALYSIS.training_data
     print_h1("Training Data")
     print_table([
         ['type', 'count', '%'],
@@ -587,7 +1077,12 @@ if __name__ == '__main__':
     print()
 
     print_h2("Most common mods")
-    print_counter_as_table(mod_training_data_counter, ["key", "count"], 50)
+    print_counter_as_table(mod_training_data_counter, ["key", "count"], 50, ANALYSIS.key_name)
     print()
 
-    write_csv_of_training_data(TRAINING_DATA)
+    if STREAM_TRAINING_DATA:
+        print(f'Written training data to {TRAIN_PATH}')
+        print(f'Written training data to {TRAIN_EVENTS_PATH}')
+    else:
+        write_csv_of_training_data(TRAINING_DATA)
+        write_binary_training_data(TRAINING_DATA)
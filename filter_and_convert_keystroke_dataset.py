@@ -1,11 +1,21 @@
 import csv
-import gzip
+import heapq
+import io
 import json
+import multiprocessing
+import os
 import sys
+import threading
+from dataclasses import dataclass, field
 from datetime import datetime
+from itertools import chain, islice
+from operator import methodcaller, itemgetter, le
 from pathlib import Path
 
-from utils.serialization import TabMinDialect
+from utils.keys import CODE_TO_LETTER, KeyVocabulary, normalize_key
+from utils.rejections import RejectionCollector
+from utils.serialization import TabMinDialect, EventStoreWriter, MultiWriter, BlockGzipWriter, \
+    ParticipantIndex, ConversionManifest, FilePrefetcher, bytes_hash
 
 DATASET_PATH = Path(__file__).parent / 'dataset'
 
@@ -14,39 +24,20 @@ CSV_DIR_PATH = EXTRACTED_ARCHIVE_PATH / "files"
 PARTICIPANTS_CSV_PATH = EXTRACTED_ARCHIVE_PATH / "metadata_participants.txt"
 
 RESULT_PATH = DATASET_PATH / "filtered_events.csv.gz"
+RESULT_STORE_PATH = DATASET_PATH / "filtered_events.columns"
 RESULT_USED_PARTICIPANTS_PATH = DATASET_PATH / "filtered_events.participants_used.json"
 RESULT_USED_PARTICIPANTS_METADATA = DATASET_PATH / "filtered_events.participants_used_metadata.csv"
-
-MAP_LETTER = {'ARW_LEFT': 'left', 'ARW_RIGHT': 'right', 'ARW_UP': 'up', 'ARw_DOWN': 'down',
-              ' ': 'space', 'BKSP': 'backspace'}
-
-CODE_TO_LETTER = {
-    '8': 'backspace', '9': 'tab', '12': 'clear', '13': 'enter', '16': 'SHIFT', '17': 'ctrl',
-    '18': 'alt', '19': 'pause', '20': 'caps_lock', '27': 'esc', '32': 'space', '33': 'page_up',
-    '34': 'page_down', '35': 'end', '36': 'home', '37': 'left', '38': 'up', '39': 'right',
-    '40': 'down', '41': 'select', '42': 'print', '43': 'execute', '44': 'print_screen',
-    '45': 'insert', '46': 'delete', '47': 'help', '48': '0', '49': '1', '50': '2', '51': '3',
-    '52': '4', '53': '5', '54': '6', '55': '7', '56': '8', '57': '9', '65': 'a', '66': 'b',
-    '67': 'c', '68': 'd', '69': 'e', '70': 'f', '71': 'g', '72': 'h', '73': 'i', '74': 'j',
-    '75': 'k', '76': 'l', '77': 'm', '78': 'n', '79': 'o', '80': 'p', '81': 'q', '82': 'r',
-    '83': 's', '84': 't', '85': 'u', '86': 'v', '87': 'w', '88': 'x', '89': 'y', '90': 'z',
-    '91': 'cmd_l', '92': 'cmd_r', '93': 'menu', '95': 'sleep', '96': 'num_0', '97': 'num_1',
-    '98': 'num_2', '99': 'num_3', '100': 'num_4', '101': 'num_5', '102': 'num_6', '103': 'num_7',
-    '104': 'num_8', '105': 'num_9', '106': '*', '107': '+', '108': 'separator', '109': '-',
-    '110': '.', '111': '/', '112': 'f1', '113': 'f2', '114': 'f3', '115': 'f4', '116': 'f5',
-    '117': 'f6', '118': 'f7', '119': 'f8', '120': 'f9', '121': 'f10', '122': 'f11', '123': 'f12',
-    '124': 'f13', '125': 'f14', '126': 'f15', '127': 'f16', '128': 'f17', '129': 'f18',
-    '130': 'f19', '131': 'f20', '132': 'f21', '133': 'f22', '134': 'f23', '135': 'f24',
-    '144': 'num_lock', '145': 'scroll_lock', '160': 'shift_l', '161': 'shift_r', '162': 'ctrl_l',
-    '163': 'ctrl_r', '164': 'alt_l', '165': 'alt_r', '166': 'browser_back',
-    '167': 'browser_forward', '168': 'browser_refresh', '169': 'browser_stop',
-    '170': 'browser_search', '171': 'browser_favorites', '172': 'browser_start_and_home',
-    '173': 'media_volume_mute', '174': 'media_volume_down', '175': 'media_volume_up',
-    '176': 'media_next', '177': 'media_previous', '178': 'media_stop', '179': 'media_play_pause',
-    '180': 'start_mail', '181': 'select_media', '182': 'start_application_1',
-    '183': 'start_application_2', '186': ';', '187': '+', '188': ',', '189': '-', '190': '.',
-    '191': '/', '219': '[', '220': '\\', '221': ']', '222': "'", '226': '<'
-}
+# where the events of each participant are in RESULT_PATH (see ParticipantIndex)
+RESULT_PARTICIPANT_INDEX_PATH = DATASET_PATH / "filtered_events.participant_index.json"
+# what was found in each participant file, and its checked events, so re-runs only parse new or changed files
+# (see ConversionManifest)
+RESULT_MANIFEST_PATH = DATASET_PATH / "filtered_events.manifest.json"
+RESULT_BLOCKS_PATH = DATASET_PATH / "filtered_events.blocks"
+# why each participant file or section was rejected (see RejectionCollector)
+RESULT_REJECTIONS_TSV_PATH = DATASET_PATH / "filtered_events.rejections.tsv"
+RESULT_REJECTIONS_JSON_PATH = DATASET_PATH / "filtered_events.rejections.json"
+# ids of the keys in the event stores, shared with analyze.py (new keys are appended)
+KEY_VOCABULARY_PATH = DATASET_PATH / "key_vocabulary.json"
 
 LAYOUT_TO_SHIFTED_KEY_TO_KEY = {
     "qwerty": {"!": "1", "@": "2", "#": "3", "$": "4", "%": "5", "^": "6", "&": "7", "*": "8",
@@ -82,132 +73,512 @@ KEYCODE_IDX = KS_HEADER.index('KEYCODE')
 
 KS_HEADER_TO_INDEX = dict(enumerate(KS_HEADER))
 
-maxInt = sys.maxsize
+# Number of processes that parse and check the participant files.
+# 1 uses the serial path, which is kept as the reference implementation.
+NUM_WORKERS = os.cpu_count() or 1
+# How many participant files each worker may parse ahead of the writer
+PARALLEL_JOBS_PER_WORKER = 16
+# Increase this when the checks change, so the files recorded in the manifest are checked again
+FILTER_VERSION = 2
+# Also parse the participants that do not pass the metadata filter into the manifest, so other cut-offs of the
+# metadata filter need no parsing either (see FilterSettings)
+PARSE_ALL_PARTICIPANTS = False
+# Parse the participant files with read_sections instead of csv.reader and get_sections (the reference).
+FAST_PARSER = True
+# Parse each participant file both ways and raise an AssertionError if the results or messages differ
+CROSS_CHECK_PARSER = False
+
+# Print each rejected file or section when it is found, but at most REJECTIONS_PER_SECOND lines per second.
+# Either way, all of them are in the reports and counted in the summary at the end.
+PRINT_REJECTIONS = False
+REJECTIONS_PER_SECOND = 10
+
+# timestamps below this are exact as floats, so int(value) == int(float(value))
+MAX_EXACT_FLOAT_INT = 1 << 53
+
+# The rules by which participant files or their sections are rejected
+RULE_HEADER = 'header is not correct'
+RULE_PARTICIPANT_ID = 'participant id differs from filename'
+RULE_INCOMPLETE_ROW = 'incomplete row'
+RULE_RELEASE_BEFORE_PRESS = 'released before pressed'
+RULE_TOO_LONG = 'took way too long'
+RULE_TOO_SHORT = 'was way too short'
+RULE_UNKNOWN_KEY = 'unknown key code'
+RULE_NO_PRESSES = 'no key presses'
+RULE_LOW_DELTA_RATIO = 'too many too short key presses'
+RULE_DOWN_TWICE = 'down but was already'
+RULE_UPPERCASE_WITHOUT_SHIFT = 'uppercase but shift not down'
+RULE_UP_WITHOUT_DOWN = 'up but not down'
+RULE_TOO_MANY_HELD = 'down with too many other keys'
+RULE_NEVER_RELEASED = 'keys never released'
+RULE_TOO_FEW_OVERLAPS = 'too few overlapping keys'
+RULE_BEFORE_2000 = 'made before year 2000'
+RULE_CSV_ERROR = 'csv error'
+
+
+@dataclass(frozen=True)
+class FilterSettings:
+    """
+    The cut-offs of the metadata filter (see passes_metadata_filter) and of the checks of the participant files
+    (see evaluate_participant). The files are parsed without them, and the features they are compared with are
+    recorded in the manifest, so trying other cut-offs does not parse the files again.
+    """
+    excluded_fingers: str = '1-2'
+    max_error_rate: float = 3.3
+    # Average WPM is around 40. In the dataset it is 60.25 (median 59.89)
+    # According to the study: Overlapping key presses indicate faster typing.
+    # We want a lot of overlap, and we want faster typists.
+    min_avg_wpm_15: float = 40
+    # faster participants without errors may have cheated (also not representable for most typists)
+    cheater_min_avg_wpm_15: float = 114
+    # a longer key press makes all times of a participant unreliable
+    max_press_ms: int = 7 * 1000
+    # key presses shorter than 10 ms
+    max_low_delta_ratio: float = 0.4
+    min_overlaps: int = 7
+
+
+FILTER_SETTINGS = FilterSettings()
+
+
+@dataclass(frozen=True)
+class ConversionConfig:
+    """
+    What convert reads and writes, and how it filters. The defaults are the module constants, which the script uses.
+    """
+    csv_dir_path: Path = CSV_DIR_PATH
+    participants_csv_path: Path = PARTICIPANTS_CSV_PATH
+    result_path: Path = RESULT_PATH
+    result_store_path: Path = RESULT_STORE_PATH
+    used_participants_path: Path = RESULT_USED_PARTICIPANTS_PATH
+    used_participants_metadata_path: Path = RESULT_USED_PARTICIPANTS_METADATA
+    participant_index_path: Path = RESULT_PARTICIPANT_INDEX_PATH
+    manifest_path: Path = RESULT_MANIFEST_PATH
+    blocks_path: Path = RESULT_BLOCKS_PATH
+    rejections_tsv_path: Path = RESULT_REJECTIONS_TSV_PATH
+    rejections_json_path: Path = RESULT_REJECTIONS_JSON_PATH
+    key_vocabulary_path: Path = KEY_VOCABULARY_PATH
+    num_workers: int = NUM_WORKERS
+    settings: FilterSettings = FILTER_SETTINGS
+    parse_all_participants: bool = PARSE_ALL_PARTICIPANTS
+    print_rejections: bool = PRINT_REJECTIONS
+    rejections_per_second: int = REJECTIONS_PER_SECOND
+
+
+@dataclass
+class ConversionStats:
+    """
+    What convert did: how many participants there are and passed the metadata filter, which of them are in the
+    results (in participant id order), how many keys they pressed, and why the others were rejected.
+    """
+    num_original_participants: int
+    num_participants_kept: int
+    used_participants: list[str]
+    num_down: int
+    rejections: RejectionCollector
 
-# find acceptable value for field size limit
-while True:
-    try:
-        csv.field_size_limit(maxInt)
-        break
-    except OverflowError:
-        maxInt = int(maxInt / 10)
 
-num_participants_kept = 0
-valid_participant_file_names = set()
-participant_id_to_layout = {}
+@dataclass
+class Participants:
+    """
+    The layout and metadata of the participants with a supported layout, and the file names of those that pass
+    the metadata filter (see filter_participants).
+    """
+    num_original: int = 0
+    id_to_layout: dict[str, str] = field(default_factory=dict)
+    id_to_metadata: dict[str, dict] = field(default_factory=dict)
+    valid_file_names: set[str] = field(default_factory=set)
 
-num_original_participants = 0
-num_down = 0
 
-participant_id_to_metadata = {}
+def raise_csv_field_size_limit():
+    """
+    Sets the largest field size limit of the csv module that this platform accepts (read_sections_with_csv_reader
+    needs it for long fields). The limit is per process, so the worker processes call it too.
+    """
+    max_int = sys.maxsize
+    while True:
+        try:
+            csv.field_size_limit(max_int)
+            break
+        except OverflowError:
+            max_int = int(max_int / 10)
 
-with PARTICIPANTS_CSV_PATH.open(mode='r', newline='', encoding='utf-8') as file:
-    reader = csv.DictReader(file, delimiter='\t')
 
-    for row in reader:
-        num_original_participants += 1
+def filter_participants(path: Path = PARTICIPANTS_CSV_PATH, settings: FilterSettings = FILTER_SETTINGS) -> Participants:
+    """
+    Reads the metadata of all participants with a supported layout from path. Those that pass the metadata filter
+    of settings are kept (see Participants.valid_file_names).
+    """
+    participants = Participants()
 
-        if not row['FINGERS'] or not row['ERROR_RATE'] or not row['AVG_WPM_15']:
-            continue
+    with path.open(mode='r', newline='', encoding='utf-8') as file:
+        reader = csv.DictReader(file, delimiter='\t')
 
-        layout = row['LAYOUT']
-        if layout not in SUPPORTED_LAYOUTS:
-            continue
-        layout = layout.strip()
+        for row in reader:
+            participants.num_original += 1
 
-        fingers = row['FINGERS'].strip()
-        error_rate = float(row['ERROR_RATE'])
-        avg_wpm_15 = float(row['AVG_WPM_15'])
+            if not row['FINGERS'] or not row['ERROR_RATE'] or not row['AVG_WPM_15']:
+                continue
 
-        if avg_wpm_15 > 114 and error_rate == 0:
-            # may have cheated (also not representable for most typists)
-            continue
+            layout = row['LAYOUT']
+            if layout not in SUPPORTED_LAYOUTS:
+                continue
+            layout = layout.strip()
 
-        # Average WPM is around 40. In the dataset it is 60.25 (median 59.89)
-        # According to the study: Overlapping key presses indicate faster typing.
-        # We want a lot of overlap, and we want faster typists.
-        if fingers != "1-2" and error_rate < 3.3 and avg_wpm_15 > 40:
-            num_participants_kept += 1
             pid = row['PARTICIPANT_ID']
-            valid_participant_file_names.add(f'{pid}_keystrokes.txt')
-            participant_id_to_layout[pid] = layout
-            participant_id_to_metadata[pid] = dict(row)
+            participants.id_to_layout[pid] = layout
+            participants.id_to_metadata[pid] = dict(row)
 
-print(num_participants_kept, 'of', num_original_participants)
+            if passes_metadata_filter(metadata_features(row), settings):
+                participants.valid_file_names.add(f'{pid}_keystrokes.txt')
 
-keystrokes_result = []
+    print(len(participants.valid_file_names), 'of', participants.num_original)
+    return participants
 
-max_dur_participant = None
-max_dur_participant_dur = None
 
-cur_t = 0
-used_participants = set()
+def metadata_features(metadata: dict) -> dict:
+    return {
+        'fingers': metadata['FINGERS'].strip(),
+        'error_rate': float(metadata['ERROR_RATE']),
+        'avg_wpm_15': float(metadata['AVG_WPM_15']),
+    }
 
 
-def parse_file(csv_path, writer):
-    global cur_t, num_down
+def passes_metadata_filter(features: dict, settings: FilterSettings) -> bool:
+    if features['avg_wpm_15'] > settings.cheater_min_avg_wpm_15 and features['error_rate'] == 0:
+        return False
 
-    if csv_path.name not in valid_participant_file_names:
-        return
+    return (features['fingers'] != settings.excluded_fingers
+            and features['error_rate'] < settings.max_error_rate
+            and features['avg_wpm_15'] > settings.min_avg_wpm_15)
 
-    participant_id = get_participant_id(csv_path)
-    layout = participant_id_to_layout.get(participant_id)
-    if not layout:
-        return
 
-    with csv_path.open(mode='r', newline='', encoding='ansi') as file:
-        reader = csv.reader(file, delimiter='\t', quoting=csv.QUOTE_NONE)
+def read_participant_events(csv_path, layout, rejections: list, features: dict, data: bytes = None):
+    """
+    Reads, sorts and checks the events of one participant file (or of data, its content, if given),
+    without the cut-offs of FilterSettings.
+    Why the file or some of its sections were ignored is appended to rejections (see reject_file and
+    reject_section), and what the cut-offs are compared with is put into features (see evaluate_participant,
+    which decides if the participant is used).
+
+    Returns None if the file is ignored whatever the cut-offs are.
+    This does not touch any global state, so it can run in a worker process.
+    """
+    if CROSS_CHECK_PARSER:
+        section_id_to_rows = cross_check_sections(csv_path, rejections, features, data)
+    elif FAST_PARSER:
+        section_id_to_rows = read_sections(csv_path, rejections, features, data)
+    else:
+        section_id_to_rows = read_sections_with_csv_reader(csv_path, rejections, features, data)
 
-        # Skip the header row
-        header = next(reader)
-        if header != KS_HEADER:
-            print_file_ignored(csv_path, f"Header is not correct: {header}")
-            return
+    if not section_id_to_rows:
+        return None
 
-        section_id_to_rows = get_sections(csv_path, reader)
+    # the events are checked while they are assembled, so they are only traversed once
+    events = []
+    issue, num_overlaps = find_issue(iter_sorted_events_of_sections(section_id_to_rows), layout, events)
+    features['issue'] = issue
+    features['num_overlaps'] = num_overlaps
+    if issue is not None:
+        return None
 
-    if not section_id_to_rows:
-        return
+    features['first_t'] = events[0][0]
+    return events
 
-    # Sort the rows of each section
-    events = sum(section_id_to_rows.values(), start=[])
-    events.sort(key=lambda ev: ev[0])
 
-    check_result = check_for_issues(events, layout)
-    if check_result is not None:
-        print_file_ignored(csv_path, check_result)
-        return
+def evaluate_participant(features: dict, rejections: list, settings: FilterSettings = FILTER_SETTINGS):
+    """
+    Whether a participant is used with the cut-offs of settings, and its rejections, given the features and
+    rejections read_participant_events found. Both are the same as if the cut-offs had been checked while
+    parsing (which stops at the first too long key press).
+    """
+    for num_rejections_before, delta, letter, press_time_ms in features['long_presses']:
+        if delta > settings.max_press_ms:
+            # We're assuming that given that this happened,
+            # all times of this participant are unreliable
+            return False, rejections[:num_rejections_before] + [
+                (None, RULE_TOO_LONG, f'{letter} at {press_time_ms} took way too long: {delta} ms')]
 
-    first_t = events[0][0]
-    last_t = events[-1][0]
+    if any(section_id is None for section_id, _, _ in rejections):
+        return False, rejections
 
-    if first_t < timestamp_of(2000, 1, 1):
-        print_file_ignored(csv_path, 'Made before year 2000')
-        return
+    if features['low_delta_ratio'] > settings.max_low_delta_ratio:
+        issue = RULE_LOW_DELTA_RATIO, 'A large percentage of key presses were too short'
+    elif features['issue'] is not None:
+        issue = features['issue']
+    elif features['num_overlaps'] < settings.min_overlaps:
+        # This could be contested. It does skew the statistics (zero overlap vs overlap etc.),
+        # but for our use case (tap hold), we do not need zero overlaps.
+        issue = RULE_TOO_FEW_OVERLAPS, f'Too few overlapping keys: {features["num_overlaps"]}'
+    elif features['first_t'] < timestamp_of(2000, 1, 1):
+        issue = RULE_BEFORE_2000, 'Made before year 2000'
+    else:
+        return True, rejections
+    return False, rejections + [(None, *issue)]
+
+
+def check_participant_file(job):
+    """
+    Checks one participant file, given its path, layout and content (see read_participant_events).
+    Returns its events (None if it is ignored), its rejections, its features and the hash of the file.
+    The rejections are collected by the caller, so they are in participant id order, and are recorded in the
+    manifest, so they are collected again when the file is not parsed again.
+
+    Runs in the worker processes.
+    """
+    csv_path, layout, data = job
+    rejections = []
+    features = {'long_presses': []}
+    try:
+        events = read_participant_events(csv_path, layout, rejections, features, data)
+    except csv.Error as e:
+        reject_file(rejections, RULE_CSV_ERROR, str(e))
+        events = None
+    except Exception as e:
+        print(csv_path, e)
+        sys.stdout.flush()
+        raise e
+    return events, rejections, features, bytes_hash(data)
+
+
+def iter_checked_in_pool(jobs, num_workers):
+    """
+    check_participant_file for each job, run in a pool of num_workers processes. The results are in the order
+    of jobs.
+    """
+    # The pool takes the jobs from its own thread as fast as it can. They are only handed out while fewer than
+    # num_workers * PARALLEL_JOBS_PER_WORKER results were not taken yet, so the parsed events cannot pile up
+    # in this process when writing is slower than parsing. It needs a whole chunk of jobs to hand them out.
+    chunksize = 4
+    read_ahead = threading.Semaphore(max(num_workers * PARALLEL_JOBS_PER_WORKER, chunksize))
+    stopped = threading.Event()
+
+    def bounded_jobs():
+        for job in jobs:
+            # without a timeout, terminating the pool would wait for its thread forever if the results are
+            # not taken anymore (e.g. if the interpreter exits after an exception)
+            while not read_ahead.acquire(timeout=0.1):
+                if stopped.is_set() or not threading.main_thread().is_alive():
+                    return
+            yield job
+
+    with multiprocessing.Pool(num_workers, initializer=raise_csv_field_size_limit) as pool:
+        try:
+            for result in pool.imap(check_participant_file, bounded_jobs(), chunksize):
+                read_ahead.release()
+                yield result
+        finally:
+            stopped.set()
+
+
+def iter_used_participants(paths, participants: Participants, manifest: ConversionManifest,
+                           rejections: RejectionCollector, config: ConversionConfig):
+    """
+    The participant id and events of each participant file that passes the metadata filter and
+    evaluate_participant with config.settings, in the order of the given paths. Why files or sections were
+    rejected is added to rejections.
+
+    Files with an up-to-date entry in the manifest are not parsed again: their events and features are read
+    from it. The others are read ahead by a FilePrefetcher, checked (in a pool of worker processes if
+    config.num_workers > 1, else in this one, which is kept as the reference implementation) and recorded.
+    Either way, the output is the same.
+    With config.parse_all_participants, the files of the participants that do not pass the metadata filter are
+    recorded too, but not yielded.
+    """
+    jobs = []
+    is_used = []
+    for csv_path in paths:
+        if csv_path.name not in participants.valid_file_names and not config.parse_all_participants:
+            continue
+
+        layout = participants.id_to_layout.get(get_participant_id(csv_path))
+        if layout:
+            jobs.append((csv_path, layout))
+            is_used.append(csv_path.name in participants.valid_file_names)
+
+    entries = [manifest.lookup(csv_path, check_settings(layout)) for csv_path, layout in jobs]
+    stale_jobs = [job for job, entry in zip(jobs, entries) if entry is None]
+    if len(stale_jobs) < len(jobs):
+        print(f'{len(jobs) - len(stale_jobs)} participant files are unchanged since the last run '
+              f'(see {manifest.path.name})')
+
+    num_workers = config.num_workers
+    # only the files that are parsed are read, in the order they are parsed in
+    with FilePrefetcher(csv_path for csv_path, _ in stale_jobs) as prefetcher:
+        checks = ((csv_path, layout, data) for (csv_path, layout), (_, data) in zip(stale_jobs, prefetcher))
+        if num_workers > 1:
+            results = iter_checked_in_pool(checks, num_workers)
+        else:
+            results = map(check_participant_file, checks)
+
+        for (csv_path, layout), entry, used in zip(jobs, entries, is_used):
+            participant_id = get_participant_id(csv_path)
+            if entry is None:
+                events, file_rejections, features, blake2b = next(results)
+                features['metadata'] = metadata_features(participants.id_to_metadata[participant_id])
+                entry = manifest.record(csv_path, check_settings(layout), blake2b, events, file_rejections, features)
+            if not used:
+                continue
 
-    cur_delta = cur_t - first_t
+            passed, file_rejections = evaluate_participant(entry['features'], entry['rejections'], config.settings)
+            manifest.set_verdict(entry, passed, next(
+                (detail for section_id, _, detail in file_rejections if section_id is None), None))
+            for section_id, rule, detail in file_rejections:
+                rejections.add(participant_id, section_id, rule, detail)
+            if passed:
+                yield participant_id, manifest.read_events(entry)
 
-    write_rows(writer, events, cur_delta)
-    num_down += len(events) // 2
 
-    # mark the end of this participant's block
-    writer.writerow((last_t + cur_delta + to_ms(seconds=30), None, None))
+def iter_participant_events(config: ConversionConfig = None, rejections: RejectionCollector = None,
+                            participants: Participants = None):
+    """
+    Filters and converts the participant files like convert, but yields (participant id, rows) of each used
+    participant instead of writing them, so the events can be consumed in this process (e.g. by analyze.py).
+    The rows are the (timestamp, down, key) rows convert writes for the participant, without the pause marker
+    after them: the timestamps are shifted so each participant starts 30 minutes after the previous one ended.
 
-    used_participants.add(participant_id)
+    Only the manifest of config is updated. Why files or sections were rejected is added to rejections, and the
+    participants default to those of config.participants_csv_path (see filter_participants).
+    """
+    if config is None:
+        config = ConversionConfig()
+    if rejections is None:
+        rejections = RejectionCollector()
+    if participants is None:
+        participants = filter_participants(config.participants_csv_path, config.settings)
+
+    raise_csv_field_size_limit()
+    paths = sorted(config.csv_dir_path.glob("*.txt"), key=lambda i: int(get_participant_id(i)))
+
+    cur_t = 0
+    with ConversionManifest(config.manifest_path, config.blocks_path) as manifest:
+        for participant_id, events in iter_used_participants(paths, participants, manifest, rejections, config):
+            # We will not map keys here to their non-shifted version, as that leads to conflicts
+            # (keys pressed down twice)
+            cur_delta = cur_t - events[0][0]
+            rows = [(t + cur_delta, down, normalize_key(letter)) for t, down, letter in events]
+            yield participant_id, rows
+            cur_t = rows[-1][0] + to_ms(minutes=30)
+
+
+def convert(config: ConversionConfig) -> ConversionStats:
+    """
+    Filters the participant files of config and writes the events of the used participants one after another
+    to config.result_path (and the event store next to it), with a pause marker after each participant.
+    Also writes the participant index, the used participants, their metadata and the rejection reports.
 
-    cur_t = last_t + cur_delta + to_ms(minutes=30)
+    A csv.Error while writing a participant rejects it, and the run continues.
+    """
+    participants = filter_participants(config.participants_csv_path, config.settings)
+    key_vocabulary = KeyVocabulary.load(config.key_vocabulary_path)
+    rejections = RejectionCollector(config.print_rejections, config.rejections_per_second)
+
+    used_participants = []
+    num_down = 0
+    # (participant id, first row, number of rows, first timestamp, last timestamp) for the ParticipantIndex
+    participant_rows = []
+
+    # the store is closed last, so it can record the final size and mtime of the result
+    with (EventStoreWriter(config.result_store_path, source_path=config.result_path,
+                           vocabulary=key_vocabulary) as store_writer,
+          BlockGzipWriter(config.result_path, split_at_pause_markers=True) as gz_file):
+        # the columnar store has the same rows, but can be memory-mapped by analyze.py
+        writer = MultiWriter(csv.writer(gz_file, dialect=TabMinDialect), store_writer)
+
+        for participant_id, rows in iter_participant_events(config, rejections, participants):
+            first_row = writer.num_rows
+            try:
+                for row in rows:
+                    writer.writerow(row)
+            except csv.Error as e:
+                rejections.add(participant_id, None, RULE_CSV_ERROR, str(e))
+                continue
+
+            last_t = rows[-1][0]
+            num_down += len(rows) // 2
+            participant_rows.append((participant_id, first_row, len(rows), rows[0][0], last_t))
+            used_participants.append(participant_id)
+
+            # mark the end of this participant's block
+            writer.writerow((last_t + to_ms(seconds=30), None, None))
+
+    key_vocabulary.save(config.key_vocabulary_path)
+    ParticipantIndex.build(config.result_path, participant_rows).save(config.participant_index_path)
+
+    rejections.write_tsv(config.rejections_tsv_path)
+    rejections.write_json(config.rejections_json_path)
+
+    config.used_participants_path.write_text(json.dumps(used_participants))
+    write_used_participants_metadata(config.used_participants_metadata_path, participants, set(used_participants))
+
+    return ConversionStats(participants.num_original, len(participants.valid_file_names), used_participants,
+                           num_down, rejections)
+
+
+def write_used_participants_metadata(path: Path, participants: Participants, used_participants: set):
+    """
+    The metadata of the used participants, fastest first.
+    """
+    with path.open('w', encoding='utf-8', newline='') as csvfile:
+        fieldnames = ['PARTICIPANT_ID', 'AGE', 'GENDER', 'HAS_TAKEN_TYPING_COURSE', 'COUNTRY', 'LAYOUT',
+                      'NATIVE_LANGUAGE',
+                      'FINGERS', 'TIME_SPENT_TYPING', 'KEYBOARD_TYPE', 'ERROR_RATE', 'AVG_WPM_15',
+                      'AVG_IKI', 'ECPC',
+                      'KSPC', 'ROR']
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, dialect=TabMinDialect)
+
+        writer.writeheader()
+        for pid, md in sorted(participants.id_to_metadata.items(),
+                              key=lambda x: float(x[1]['AVG_WPM_15']), reverse=True):
+            if pid in used_participants:
+                writer.writerow(md)
+
+
+def check_settings(layout) -> dict:
+    """
+    Everything besides the file that decides how a participant file is checked (see ConversionManifest.lookup).
+    """
+    return {'layout': layout, 'filter_version': FILTER_VERSION}
 
 
 def get_participant_id(path: Path) -> str:
     return path.name.split('_')[0]
 
 
-def get_sections(csv_path, reader):
+def read_sections_with_csv_reader(csv_path, rejections: list, features: dict, data: bytes = None):
+    """
+    Reads the sections of csv_path (see get_sections), or of data if it is the content of csv_path already.
+    """
+    if data is None:
+        file = csv_path.open(mode='r', newline='', encoding='ansi')
+    else:
+        file = io.TextIOWrapper(io.BytesIO(data), newline='', encoding='ansi')
+
+    with file:
+        reader = csv.reader(file, delimiter='\t', quoting=csv.QUOTE_NONE)
+
+        # Skip the header row
+        header = next(reader)
+        if header != KS_HEADER:
+            reject_file(rejections, RULE_HEADER, f"Header is not correct: {header}")
+            return None
+
+        return get_sections(csv_path, reader, rejections, features)
+
+
+def get_sections(csv_path, reader, rejections: list, features: dict):
+    """
+    The rows of the sections of a participant file, without the cut-offs of FilterSettings: each key press that is
+    longer than all before is added to features['long_presses'] (with the number of rejections before it), and
+    the number of presses and of those shorter than 10 ms are put into features (see evaluate_participant).
+    """
     section_id_to_rows = {}
     ignored_section_ids = set()
     num_presses = 0
 
     num_low_delta = 0
+    max_delta = -1
+    long_presses = features['long_presses']
 
     check_if_section_was_finished = False
     prev_section_id = None
@@ -219,8 +590,8 @@ def get_sections(csv_path, reader):
             continue
 
         if row[PARTICIPANT_IDX] != participant_id:
-            print_file_ignored(csv_path,
-                               f'Participant ID differs from filename: {row[PARTICIPANT_IDX]}')
+            reject_file(rejections, RULE_PARTICIPANT_ID,
+                        f'Participant ID differs from filename: {row[PARTICIPANT_IDX]}')
             return
 
         section_id = row[SECTION_IDX]
@@ -230,7 +601,7 @@ def get_sections(csv_path, reader):
         if check_if_section_was_finished:
             check_if_section_was_finished = False
             if section_id == prev_section_id:
-                print_section_ignored(csv_path, section_id, 'There was an incomplete row')
+                reject_section(rejections, section_id, RULE_INCOMPLETE_ROW, 'There was an incomplete row')
                 del section_id_to_rows[section_id]
                 ignored_section_ids.add(section_id)
                 continue
@@ -249,19 +620,18 @@ def get_sections(csv_path, reader):
         letter = row[LETTER_IDX]
 
         if delta < 0:
-            # release before press
+            reject_section(rejections, section_id, RULE_RELEASE_BEFORE_PRESS,
+                           f'{letter} at {press_time_ms} was released before it was pressed: {delta} ms')
             del section_id_to_rows[section_id]
             ignored_section_ids.add(section_id)
             continue
-        elif delta > to_ms(seconds=7):
-            # We're assuming that given that this happened,
-            # all times of this participant are unreliable
-            print_file_ignored(csv_path,
-                               f'{letter} at {press_time_ms} took way too long: {delta} ms')
-            return
-        elif delta < 1:
-            print_section_ignored(csv_path, section_id,
-                                  f'{letter} at {press_time_ms} was way too short: {delta} ms')
+        elif delta > max_delta:
+            max_delta = delta
+            long_presses.append((len(rejections), delta, letter, press_time_ms))
+
+        if delta < 1:
+            reject_section(rejections, section_id, RULE_TOO_SHORT,
+                           f'{letter} at {press_time_ms} was way too short: {delta} ms')
             del section_id_to_rows[section_id]
             ignored_section_ids.add(section_id)
             continue
@@ -277,6 +647,8 @@ def get_sections(csv_path, reader):
             letter = CODE_TO_LETTER.get(code)
 
         if letter is None:
+            reject_section(rejections, section_id, RULE_UNKNOWN_KEY,
+                           f'Unknown key code {row[KEYCODE_IDX]} at {press_time_ms}')
             del section_id_to_rows[section_id]
             ignored_section_ids.add(section_id)
             continue
@@ -290,21 +662,206 @@ def get_sections(csv_path, reader):
         section.append([release_time_ms, 0, letter])
 
     if not section_id_to_rows or not num_presses:
+        reject_file(rejections, RULE_NO_PRESSES, 'No section with key presses is left')
         return
 
-    if (num_low_delta / num_presses) > 0.4:
-        print_file_ignored(csv_path, 'A large percentage of key presses were too short')
+    features['max_delta'] = max_delta
+    features['num_presses'] = num_presses
+    features['num_low_delta'] = num_low_delta
+    features['low_delta_ratio'] = num_low_delta / num_presses
+    return section_id_to_rows
+
+
+def read_sections(csv_path, rejections: list, features: dict, data: bytes = None):
+    """
+    Same as read_sections_with_csv_reader, with the same messages, but faster: the file is read and decoded
+    at once, split into lines and columns with str methods, and the times of all rows are converted in bulk.
+    The letters are checked once per distinct letter.
+    """
+    if data is None:
+        data = csv_path.read_bytes()
+    text = data.decode(encoding='ansi')
+
+    # like the lines of a file opened with newline='', which csv.reader splits at '\t' (as it quotes nothing)
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    rows = map(methodcaller('split', '\t'), lines)
+
+    # Skip the header row
+    header = next(rows)
+    if header != KS_HEADER:
+        reject_file(rejections, RULE_HEADER, f"Header is not correct: {header}")
+        return None
+
+    return get_sections_of_rows(csv_path, list(rows), rejections, features)
+
+
+def times_in_ms(values: list[str]) -> list:
+    """
+    int(float(value)) for each value (so "1.473278e+12" works), or None where that raises.
+    """
+    try:
+        times = list(map(int, values))
+        if times and -MAX_EXACT_FLOAT_INT < min(times) and max(times) < MAX_EXACT_FLOAT_INT:
+            return times
+    except ValueError:
+        pass
+
+    try:
+        return list(map(int, map(float, values)))
+    except (ValueError, OverflowError):
+        return [time_in_ms_or_none(value) for value in values]
+
+
+def time_in_ms_or_none(value: str):
+    try:
+        return int(float(value))
+    except (ValueError, OverflowError):
+        return None
+
+
+def get_sections_of_rows(csv_path, rows: list[list[str]], rejections: list, features: dict):
+    """
+    Same as get_sections, but for rows that are already split into columns (see read_sections).
+    """
+    section_id_to_rows = {}
+    ignored_section_ids = set()
+    num_presses = 0
+
+    num_low_delta = 0
+    max_delta = -1
+    long_presses = features['long_presses']
+
+    check_if_section_was_finished = False
+    prev_section_id = None
+    participant_id = get_participant_id(csv_path)
+
+    # incomplete rows get a dummy time, as they are skipped anyway
+    press_times = times_in_ms([row[PRESS_TIME_IDX] if len(row) >= 8 else '0' for row in rows])
+    release_times = times_in_ms([row[RELEASE_TIME_IDX] if len(row) >= 8 else '0' for row in rows])
+
+    # letter -> the letter if it is usable, else None (then the key code is used)
+    usable_letters = {}
+
+    for row, press_time_ms, release_time_ms in zip(rows, press_times, release_times):
+        if len(row) < 8 or row[-1] == '':
+            check_if_section_was_finished = True
+            continue
+
+        if row[PARTICIPANT_IDX] != participant_id:
+            reject_file(rejections, RULE_PARTICIPANT_ID,
+                        f'Participant ID differs from filename: {row[PARTICIPANT_IDX]}')
+            return
+
+        section_id = row[SECTION_IDX]
+        if not section_id or section_id in ignored_section_ids:
+            continue
+
+        if check_if_section_was_finished:
+            check_if_section_was_finished = False
+            if section_id == prev_section_id:
+                reject_section(rejections, section_id, RULE_INCOMPLETE_ROW, 'There was an incomplete row')
+                del section_id_to_rows[section_id]
+                ignored_section_ids.add(section_id)
+                continue
+
+        section = section_id_to_rows.get(section_id)
+        if section is None:
+            section = []
+            section_id_to_rows[section_id] = section
+
+        if press_time_ms is None or release_time_ms is None:
+            # raises the same error as get_sections
+            int(float(row[PRESS_TIME_IDX]))
+            int(float(row[RELEASE_TIME_IDX]))
+
+        delta = release_time_ms - press_time_ms
+
+        letter = row[LETTER_IDX]
+
+        if delta < 0:
+            reject_section(rejections, section_id, RULE_RELEASE_BEFORE_PRESS,
+                           f'{letter} at {press_time_ms} was released before it was pressed: {delta} ms')
+            del section_id_to_rows[section_id]
+            ignored_section_ids.add(section_id)
+            continue
+        elif delta > max_delta:
+            max_delta = delta
+            long_presses.append((len(rejections), delta, letter, press_time_ms))
+
+        if delta < 1:
+            reject_section(rejections, section_id, RULE_TOO_SHORT,
+                           f'{letter} at {press_time_ms} was way too short: {delta} ms')
+            del section_id_to_rows[section_id]
+            ignored_section_ids.add(section_id)
+            continue
+
+        if letter in usable_letters:
+            usable_letter = usable_letters[letter]
+        else:
+            usable_letter = usable_letters[letter] = letter if letter != '' and letter.isprintable() else None
+
+        if usable_letter is None:
+            letter = CODE_TO_LETTER.get(row[KEYCODE_IDX])
+            if letter is None:
+                reject_section(rejections, section_id, RULE_UNKNOWN_KEY,
+                               f'Unknown key code {row[KEYCODE_IDX]} at {press_time_ms}')
+                del section_id_to_rows[section_id]
+                ignored_section_ids.add(section_id)
+                continue
+
+        if delta < 10:
+            num_low_delta += 1
+
+        prev_section_id = section_id
+        num_presses += 1
+        section.append([press_time_ms, 1, letter])
+        section.append([release_time_ms, 0, letter])
+
+    if not section_id_to_rows or not num_presses:
+        reject_file(rejections, RULE_NO_PRESSES, 'No section with key presses is left')
         return
 
+    features['max_delta'] = max_delta
+    features['num_presses'] = num_presses
+    features['num_low_delta'] = num_low_delta
+    features['low_delta_ratio'] = num_low_delta / num_presses
     return section_id_to_rows
 
 
-def print_file_ignored(csv_path, message):
-    print(f'{csv_path.name} IGNORED: {message}')
+def cross_check_sections(csv_path, rejections: list, features: dict, data: bytes = None):
+    """
+    Reads csv_path with both read_sections and read_sections_with_csv_reader, and raises an AssertionError
+    if their results, rejections, features or errors differ. Otherwise, it is like read_sections.
+    """
+    outcomes = []
+    for read in (read_sections, read_sections_with_csv_reader):
+        read_rejections = list(rejections)
+        read_features = {**features, 'long_presses': list(features['long_presses'])}
+        try:
+            outcomes.append((read(csv_path, read_rejections, read_features, data),
+                             read_rejections, read_features, None))
+        except Exception as e:
+            outcomes.append((None, read_rejections, read_features, e))
+
+    (result, read_rejections, read_features, error), reference = outcomes
+    if (result, read_rejections, read_features, repr(error)) != (*reference[:3], repr(reference[3])):
+        raise AssertionError(f'read_sections differs from read_sections_with_csv_reader for {csv_path.name}')
+
+    rejections[:] = read_rejections
+    features.update(read_features)
+    if error is not None:
+        raise error
+    return result
+
 
+def reject_file(rejections: list, rule: str, detail: str):
+    rejections.append((None, rule, detail))
 
-def print_section_ignored(csv_path, section_id, message):
-    print(f'{csv_path.name} SECTION {section_id} IGNORED: {message}')
+
+def reject_section(rejections: list, section_id: str, rule: str, detail: str):
+    rejections.append((section_id, rule, detail))
 
 
 def to_ms(minutes=0, seconds=0):
@@ -319,44 +876,77 @@ def to_timestamp(dt: datetime):
     return int(dt.timestamp() * 1000)
 
 
-def check_for_issues(events, layout):
-    down_lower_letters = {}
+def find_issue(events, layout, assembled: list = None):
+    """
+    Returns the rule and detail of why the events (sorted by time) of a participant are not usable whatever
+    the cut-offs of FilterSettings are (or None), and the number of presses while other keys were down.
+    With assembled, each checked event is appended to it, so events can be an iterator that assembles them.
+
+    The number of other keys pressed while a key was down is the number of presses since its own press,
+    so for each held key, only the number of presses at its press is kept (in press_snapshots).
+    That way, a press takes the same time however many keys are held.
+    """
+    press_snapshots = {}
+    num_presses = 0
     num_overlap = 0
     uppercase = LAYOUT_TO_UPPERCASE[layout]
+    letter_to_lower = {}
+    append = None if assembled is None else assembled.append
 
     for row in events:
+        if append is not None:
+            append(row)
+
         t, down, letter = row
-        lower_letter = letter.lower()
+        lower_letter = letter_to_lower.get(letter)
+        if lower_letter is None:
+            lower_letter = letter_to_lower[letter] = letter.lower()
 
         if down:
-            if down_lower_letters:
-                for k in down_lower_letters:
-                    down_lower_letters[k] += 1
+            if press_snapshots:
                 num_overlap += 1
+            num_presses += 1
 
-            if lower_letter in down_lower_letters:
-                return f'{letter} down at {t} but was already'
-            down_lower_letters[lower_letter] = 0
+            if lower_letter in press_snapshots:
+                return (RULE_DOWN_TWICE, f'{letter} down at {t} but was already'), num_overlap
+            press_snapshots[lower_letter] = num_presses
 
-            if letter in uppercase and 'shift' not in down_lower_letters:
-                return f'{letter} is uppercase at {t} but shift is not down'
+            if letter in uppercase and 'shift' not in press_snapshots:
+                issue = RULE_UPPERCASE_WITHOUT_SHIFT, f'{letter} is uppercase at {t} but shift is not down'
+                return issue, num_overlap
         else:
-            if lower_letter not in down_lower_letters:
-                return f'{letter} up at {t} but is not even down'
+            snapshot = press_snapshots.pop(lower_letter, None)
+            if snapshot is None:
+                return (RULE_UP_WITHOUT_DOWN, f'{letter} up at {t} but is not even down'), num_overlap
 
-            down_with_n_keys = down_lower_letters.pop(lower_letter)
+            down_with_n_keys = num_presses - snapshot
             if lower_letter not in ('shift', 'ctrl') and down_with_n_keys > 3:
-                return f'{letter} up at {t} was down with {down_with_n_keys} other keys at the same time'
+                return (RULE_TOO_MANY_HELD,
+                        f'{letter} up at {t} was down with {down_with_n_keys} other keys at the same time'), num_overlap
 
-    if down_lower_letters:
-        return f'Some keys were never released: {down_lower_letters}'
+    if press_snapshots:
+        down_lower_letters = {k: num_presses - snapshot for k, snapshot in press_snapshots.items()}
+        return (RULE_NEVER_RELEASED, f'Some keys were never released: {down_lower_letters}'), num_overlap
 
-    if num_overlap < 7:
-        # This could be contested. It does skew the statistics (zero overlap vs overlap etc.),
-        # but for our use case (tap hold), we do not need zero overlaps.
-        return f'Too few overlapping keys: {num_overlap}'
+    return None, num_overlap
 
-    return None
+
+def iter_sorted_events_of_sections(section_id_to_rows):
+    """
+    The rows of all sections, sorted by time. The order is the same as that of stably sorting their
+    concatenation, but each section is only sorted if it is not sorted yet, and the sections are only merged
+    (with heapq.merge, which is stable too) if they overlap. Usually, they follow each other, so they are
+    just concatenated.
+    """
+    sections = [section for section in section_id_to_rows.values() if section]
+    for section in sections:
+        times = list(map(itemgetter(0), section))
+        if not all(map(le, times, islice(times, 1, None))):
+            section.sort(key=itemgetter(0))
+
+    if find_overlapping_timestamp(sections) is None:
+        return chain.from_iterable(sections)
+    return heapq.merge(*sections, key=itemgetter(0))
 
 
 def find_overlapping_timestamp(sections):
@@ -379,19 +969,6 @@ def find_overlapping_timestamp(sections):
     return None
 
 
-def write_rows(writer, events, delta):
-    # We will not map keys here to their non-shifted version, as that leads to conflicts (keys pressed down twice)
-    for row in events:
-        dt, down, letter = row
-        letter = MAP_LETTER.get(letter, letter)
-        last_t = dt + delta
-
-        try:
-            writer.writerow((last_t, down, letter.lower().strip().replace(' ', '_')))
-        except csv.Error as e:
-            raise e
-
-
 def size_in_mib(path: Path) -> float:
     return path.stat().st_size / (1024 * 1024)
 
@@ -400,36 +977,11 @@ def name_and_size(path: Path) -> str:
     return f'{path.name}: {size_in_mib(path)} MiB'
 
 
-with gzip.open(str(RESULT_PATH), 'wt', newline='', encoding='utf-8') as gz_file:
-    writer = csv.writer(gz_file, dialect=TabMinDialect)
+if __name__ == '__main__':
+    stats = convert(ConversionConfig())
 
-    for path in sorted(CSV_DIR_PATH.glob("*.txt"), key=lambda i: int(get_participant_id(i))):
-        try:
-            parse_file(path, writer)
-        except csv.Error as e:
-            print(f'{path.name} IGNORED: {e}')
-        except Exception as e:
-            print(path, e)
-            raise e
-
-print(f"{len(used_participants)} participants left")
-print(f'{num_down} keys down (and up)')
-print(name_and_size(RESULT_PATH))
-
-RESULT_USED_PARTICIPANTS_PATH.write_text(
-    json.dumps(sorted(used_participants, key=int))
-)
-
-with RESULT_USED_PARTICIPANTS_METADATA.open('w', encoding='utf-8', newline='') as csvfile:
-    fieldnames = ['PARTICIPANT_ID', 'AGE', 'GENDER', 'HAS_TAKEN_TYPING_COURSE', 'COUNTRY', 'LAYOUT',
-                  'NATIVE_LANGUAGE',
-                  'FINGERS', 'TIME_SPENT_TYPING', 'KEYBOARD_TYPE', 'ERROR_RATE', 'AVG_WPM_15',
-                  'AVG_IKI', 'ECPC',
-                  'KSPC', 'ROR']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames, dialect=TabMinDialect)
-
-    writer.writeheader()
-    for pid, md in sorted(participant_id_to_metadata.items(),
-                          key=lambda x: float(x[1]['AVG_WPM_15']), reverse=True):
-        if pid in used_participants:
-            writer.writerow(md)
+    print(f"{len(stats.used_participants)} participants left")
+    print(f'{stats.num_down} keys down (and up)')
+    print(name_and_size(RESULT_PATH))
+
+    stats.rejections.print_summary()
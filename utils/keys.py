@@ -0,0 +1,199 @@
+import json
+from functools import cache
+from pathlib import Path
+
+from utils.constants import MOD_KEYS, MAIN_AREA_KEYS
+
+MAP_LETTER = {'ARW_LEFT': 'left', 'ARW_RIGHT': 'right', 'ARW_UP': 'up', 'ARw_DOWN': 'down',
+              ' ': 'space', 'BKSP': 'backspace'}
+
+CODE_TO_LETTER = {
+    '8': 'backspace', '9': 'tab', '12': 'clear', '13': 'enter', '16': 'SHIFT', '17': 'ctrl',
+    '18': 'alt', '19': 'pause', '20': 'caps_lock', '27': 'esc', '32': 'space', '33': 'page_up',
+    '34': 'page_down', '35': 'end', '36': 'home', '37': 'left', '38': 'up', '39': 'right',
+    '40': 'down', '41': 'select', '42': 'print', '43': 'execute', '44': 'print_screen',
+    '45': 'insert', '46': 'delete', '47': 'help', '48': '0', '49': '1', '50': '2', '51': '3',
+    '52': '4', '53': '5', '54': '6', '55': '7', '56': '8', '57': '9', '65': 'a', '66': 'b',
+    '67': 'c', '68': 'd', '69': 'e', '70': 'f', '71': 'g', '72': 'h', '73': 'i', '74': 'j',
+    '75': 'k', '76': 'l', '77': 'm', '78': 'n', '79': 'o', '80': 'p', '81': 'q', '82': 'r',
+    '83': 's', '84': 't', '85': 'u', '86': 'v', '87': 'w', '88': 'x', '89': 'y', '90': 'z',
+    '91': 'cmd_l', '92': 'cmd_r', '93': 'menu', '95': 'sleep', '96': 'num_0', '97': 'num_1',
+    '98': 'num_2', '99': 'num_3', '100': 'num_4', '101': 'num_5', '102': 'num_6', '103': 'num_7',
+    '104': 'num_8', '105': 'num_9', '106': '*', '107': '+', '108': 'separator', '109': '-',
+    '110': '.', '111': '/', '112': 'f1', '113': 'f2', '114': 'f3', '115': 'f4', '116': 'f5',
+    '117': 'f6', '118': 'f7', '119': 'f8', '120': 'f9', '121': 'f10', '122': 'f11', '123': 'f12',
+    '124': 'f13', '125': 'f14', '126': 'f15', '127': 'f16', '128': 'f17', '129': 'f18',
+    '130': 'f19', '131': 'f20', '132': 'f21', '133': 'f22', '134': 'f23', '135': 'f24',
+    '144': 'num_lock', '145': 'scroll_lock', '160': 'shift_l', '161': 'shift_r', '162': 'ctrl_l',
+    '163': 'ctrl_r', '164': 'alt_l', '165': 'alt_r', '166': 'browser_back',
+    '167': 'browser_forward', '168': 'browser_refresh', '169': 'browser_stop',
+    '170': 'browser_search', '171': 'browser_favorites', '172': 'browser_start_and_home',
+    '173': 'media_volume_mute', '174': 'media_volume_down', '175': 'media_volume_up',
+    '176': 'media_next', '177': 'media_previous', '178': 'media_stop', '179': 'media_play_pause',
+    '180': 'start_mail', '181': 'select_media', '182': 'start_application_1',
+    '183': 'start_application_2', '186': ';', '187': '+', '188': ',', '189': '-', '190': '.',
+    '191': '/', '219': '[', '220': '\\', '221': ']', '222': "'", '226': '<'
+}
+
+# The pause marker rows (written as (t, None, None)) have this id and the key ''.
+PAUSE_MARKER_KEY_ID = 0
+PAUSE_MARKER_KEY = ''
+
+# Bits per key id in a chord code (see add_to_chord). The event stores hold 16-bit key ids.
+KEY_ID_BITS = 16
+KEY_ID_MASK = (1 << KEY_ID_BITS) - 1
+
+
+@cache
+def normalize_key(letter: str) -> str:
+    """
+    The key the converter writes for a letter of the raw dataset. Cached, as there are only a few hundred
+    different letters, but millions of events.
+    """
+    letter = MAP_LETTER.get(letter, letter)
+    return letter.lower().strip().replace(' ', '_')
+
+
+def seed_keys() -> list[str]:
+    keys = [PAUSE_MARKER_KEY]
+    keys += (normalize_key(letter) for letter in CODE_TO_LETTER.values())
+    keys += (normalize_key(letter) for letter in MAP_LETTER.values())
+    keys += sorted(MOD_KEYS)
+    keys += sorted(MAIN_AREA_KEYS)
+    return keys
+
+
+class KeyVocabulary:
+    """
+    Gives each key a dense integer id, so the converter, the event stores and the analysis can work on
+    small ints instead of strings. Id 0 is the pause marker.
+
+    Ids are never reassigned: new keys are appended, and save() persists the vocabulary, so an id means the
+    same key in every file written with it.
+    """
+    def __init__(self, keys=None):
+        self.keys = []
+        self.key_to_id = {}
+        for key in seed_keys() if keys is None else keys:
+            self.id_of(key)
+
+        if self.keys[PAUSE_MARKER_KEY_ID] != PAUSE_MARKER_KEY:
+            raise ValueError(f'key id {PAUSE_MARKER_KEY_ID} must be the pause marker')
+        self.changed = False
+
+    @classmethod
+    def load(cls, path: Path) -> 'KeyVocabulary':
+        """
+        The vocabulary saved at path, or the seeded one if there is none yet.
+        """
+        if not path.exists():
+            return cls()
+        return cls(json.loads(path.read_text(encoding='utf-8')))
+
+    def save(self, path: Path):
+        path.write_text(json.dumps(self.keys, ensure_ascii=False), encoding='utf-8')
+        self.changed = False
+
+    def id_of(self, key: str) -> int:
+        """
+        The id of key, which is added if it is not known yet.
+        """
+        key_id = self.key_to_id.get(key)
+        if key_id is None:
+            key_id = len(self.keys)
+            self.keys.append(key)
+            self.key_to_id[key] = key_id
+            self.changed = True
+        return key_id
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, key_id: int) -> str:
+        return self.keys[key_id]
+
+
+def lookup_table(keys: list[str], key_set) -> list[bool]:
+    """
+    For each key id, whether its key is in key_set (e.g. lookup_table(keys, MOD_KEYS)[key_id]).
+    """
+    return [key in key_set for key in keys]
+
+
+class KeyTables:
+    """
+    Precomputed membership of the key ids of keys (e.g. EventStore.keys) in MOD_KEYS and MAIN_AREA_KEYS.
+    """
+    def __init__(self, keys: list[str]):
+        self.keys = keys
+        self.is_mod = lookup_table(keys, MOD_KEYS)
+        self.is_main_area = lookup_table(keys, MAIN_AREA_KEYS)
+
+    def update(self):
+        """
+        Extends the tables by the keys that were appended to keys since (e.g. by KeyVocabulary.id_of).
+        """
+        new_keys = self.keys[len(self.is_mod):]
+        if new_keys:
+            self.is_mod += lookup_table(new_keys, MOD_KEYS)
+            self.is_main_area += lookup_table(new_keys, MAIN_AREA_KEYS)
+
+    def id_of(self, key: str):
+        """
+        The id of key, or None if it is not in keys.
+        """
+        try:
+            return self.keys.index(key)
+        except ValueError:
+            return None
+
+
+def add_to_chord(chord: int, key_id: int) -> int:
+    """
+    A chord code is an int of the key ids of the held down keys in press order, KEY_ID_BITS each,
+    with the first pressed key in the most significant bits. 0 is the empty chord.
+    As the pause marker (id 0) is never held down, each chord has exactly one code.
+    """
+    return (chord << KEY_ID_BITS) | key_id
+
+
+def remove_from_chord(chord: int, num_pressed_after: int) -> int:
+    """
+    Removes the key id, after which num_pressed_after other keys of the chord were pressed.
+    """
+    low_bits = KEY_ID_BITS * num_pressed_after
+    low = chord & ((1 << low_bits) - 1)
+    return ((chord >> (low_bits + KEY_ID_BITS)) << low_bits) | low
+
+
+def chord_key_ids(chord: int) -> list[int]:
+    key_ids = []
+    while chord:
+        key_ids.append(chord & KEY_ID_MASK)
+        chord >>= KEY_ID_BITS
+    key_ids.reverse()
+    return key_ids
+
+
+def pair_code(first_key_id: int, second_key_id: int) -> int:
+    """
+    A code of an ordered pair of key ids, KEY_ID_BITS each. Unlike a code based on the number of keys, it stays
+    the same when keys are added to the vocabulary.
+    """
+    return (first_key_id << KEY_ID_BITS) | second_key_id
+
+
+def pair_key_ids(pair: int) -> tuple[int, int]:
+    return pair >> KEY_ID_BITS, pair & KEY_ID_MASK
+
+
+def mask_key_ids(mask: int) -> list[int]:
+    """
+    The key ids of the set bits of mask (bit i is key id i, like the keys of Analysis.mods_simultaneous_counts).
+    """
+    key_ids = []
+    while mask:
+        low_bit = mask & -mask
+        key_ids.append(low_bit.bit_length() - 1)
+        mask ^= low_bit
+    return key_ids
@@ -216,6 +216,166 @@ class AlternatingPatternMatcher:
                     i = m[continue_at_letter] + continue_after_offset
 
 
+class _MatcherState:
+    """
+    A state of CompiledAlternatingPatternMatcher. It is the state get_match is in after some events were
+    matched, without the actual keys: a letter is only bound to the index of a key class (letters matching
+    the same key share a class). transitions maps (is_down, key class) of the next event to the next state.
+    """
+    __slots__ = ('loi', 'one_of', 'letter_class', 'num_classes', 'letters', 'is_complete', 'transitions')
+
+    def __init__(self, loi, one_of, letter_class, num_classes, letters, is_complete):
+        self.loi = loi
+        self.one_of = one_of
+        self.letter_class = letter_class
+        self.num_classes = num_classes
+        self.letters = letters
+        self.is_complete = is_complete
+        self.transitions = {}
+
+
+class CompiledAlternatingPatternMatcher(AlternatingPatternMatcher):
+    """
+    Finds the same matches as AlternatingPatternMatcher.all_matches, but reads every event only once.
+
+    The steps get_match takes for an event only depend on whether it is down, and on which of the already
+    matched letters have the same key. So the pattern is compiled (lazily) into a state machine over those
+    two properties. All partial matches that started at earlier events are advanced together, so nothing has
+    to be reset or matched again when a start index fails.
+
+    The original AlternatingPatternMatcher is kept as the reference implementation.
+
+    Unlike the reference, all_matches raises a ValueError if it would continue at or before the start of the
+    match it just found (e.g. continue_at_letter is the first letter of the pattern). The reference yields the
+    same match forever in that case.
+    """
+    def __init__(self, pattern: str, down_index: int = 0, key_index: int = 1):
+        super().__init__(pattern, down_index, key_index)
+        self.one_of_index = {id(lo): i for i, lo in enumerate(self.unique_one_of)}
+        self.states = {}
+        self.start_state = self._state(0, tuple((0, False) for _ in self.unique_one_of), (), 0, ())
+
+    def _state(self, loi, one_of, letter_class, num_classes, letters):
+        state_key = (loi, one_of, letter_class, num_classes, letters)
+        state = self.states.get(state_key)
+        if state is None:
+            is_complete = len(letters) == self.match_length or loi >= self.pattern_length
+            state = self.states[state_key] = _MatcherState(*state_key, is_complete)
+        return state
+
+    def _transition(self, state: _MatcherState, is_down, key_class) -> Optional[_MatcherState]:
+        """
+        Does the same as one iteration of the outer loop in get_match.
+        key_class is state.num_classes if the key is not one of the already matched ones.
+        """
+        loi = state.loi
+        one_of = list(state.one_of)
+        letter_class = dict(state.letter_class)
+        num_classes = state.num_classes
+
+        def match(letter):
+            nonlocal num_classes
+            if is_down != letter.islower():
+                return False
+
+            ll = letter.lower()
+            c = letter_class.get(ll)
+            if c is None:
+                letter_class[ll] = key_class
+                if key_class == num_classes:
+                    num_classes += 1
+                return True
+            return c == key_class
+
+        while loi < self.pattern_length:
+            lo = self.letter_or_one_of[loi]
+            loi += 1
+
+            if isinstance(lo, OneOf):
+                oi = self.one_of_index[id(lo)]
+                not_chosen_count, has_chosen = one_of[oi]
+                if has_chosen:
+                    continue
+                elif match(lo.content):
+                    one_of[oi] = (not_chosen_count, True)
+                    letter = lo.content
+                    break
+                elif not_chosen_count + 1 >= lo.size:
+                    return None
+                one_of[oi] = (not_chosen_count + 1, False)
+            elif match(lo):
+                letter = lo
+                break
+            else:
+                return None
+        else:
+            # the event was not used, get_match returns what was matched so far
+            return self._state(loi, state.one_of, state.letter_class, state.num_classes, state.letters + (None,))
+
+        return self._state(loi, tuple(one_of), tuple(sorted(letter_class.items())), num_classes,
+                           state.letters + (letter,))
+
+    def all_matches(self,
+                    events: list[tuple],
+                    start_index: int = 0,
+                    continue_after_offset: int = 0,
+                    continue_at_letter: Optional[str] = None
+                    ) -> Generator[dict[str, int]]:
+        step_size = self.match_length + continue_after_offset
+        last_possible_i = len(events) - self.match_length - 1
+        down_index = self.down_index
+        key_index = self.key_index
+
+        next_start = start_index
+        # partial matches ordered by their start index: [start index, state, keys of the key classes]
+        partial_matches = []
+
+        for i in range(start_index, len(events)):
+            if next_start <= i <= last_possible_i:
+                partial_matches.append((i, self.start_state, []))
+            elif not partial_matches:
+                if i > last_possible_i:
+                    break
+                continue
+
+            event = events[i]
+            is_down = event[down_index]
+            key = event[key_index]
+
+            advanced = []
+            for start, state, keys in partial_matches:
+                if start < next_start:
+                    continue
+
+                key_class = keys.index(key) if key in keys else len(keys)
+                next_state = state.transitions.get((is_down, key_class), state)
+                if next_state is state:
+                    next_state = state.transitions[(is_down, key_class)] = self._transition(state, is_down, key_class)
+
+                if next_state is None:
+                    continue
+
+                if next_state.num_classes > len(keys):
+                    keys.append(key)
+
+                if not next_state.is_complete:
+                    advanced.append((start, next_state, keys))
+                    continue
+
+                m = {letter: j for j, letter in enumerate(next_state.letters, start) if letter is not None}
+                yield m
+
+                if continue_at_letter is None:
+                    next_start = start + step_size
+                else:
+                    next_start = m[continue_at_letter] + continue_after_offset
+
+                if next_start <= start:
+                    raise ValueError(f'matching would not continue after the match at {start}')
+
+            partial_matches = advanced
+
+
 if __name__ == '__main__':
     print(permutations_of_pattern('fFpFPFxPnzXzNzXz'))
 
@@ -481,3 +641,37 @@ if __name__ == '__main__':
 
         print(
             f"Test {i + 1}: Pattern='{case['pattern']}', Events={case['events']}, Start={case['start_index']}, Expected={case['expected']}, Result={result}, {status}")
+
+    # the compiled matcher must find exactly the same matches as the reference implementation
+    import random
+    from itertools import islice
+
+    rnd = random.Random(0)
+    patterns = ['ApAPAxPnzXzNzXz', 'fFpFPFhPnHNH', 'hnHNHxH', 'FxFzXz', 'azAz', 'pPxPnN', 'abBA', 'abAB', 'xYX', 'abc']
+    for pattern in patterns:
+        for letter in [None] + sorted(set(pattern)):
+            for _ in range(20):
+                down = set()
+                events = []
+                for _ in range(rnd.randint(0, 200)):
+                    key = rnd.choice('abcdef')
+                    events.append((key not in down, key))
+                    down ^= {key}
+
+                # if it continues at the start of a match, the reference yields that match forever,
+                # so we only take one more match than there can be
+                expected = list(islice(AlternatingPatternMatcher(pattern).all_matches(
+                    events, continue_at_letter=letter), len(events) + 1))
+                is_endless = len(expected) > len(events)
+
+                compiled = CompiledAlternatingPatternMatcher(pattern)
+                try:
+                    result = list(compiled.all_matches(events, continue_at_letter=letter))
+                    status = "PASSED" if not is_endless and result == expected else "FAILED"
+                except ValueError:
+                    status = "PASSED" if is_endless else "FAILED"
+                    result = 'ValueError'
+
+                if status != "PASSED":
+                    print(f"FAILED: compiled all_matches of '{pattern}' with {letter=}, {events=}: "
+                          f"{result} vs {expected[:5]}")
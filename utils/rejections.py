@@ -0,0 +1,114 @@
+import csv
+import json
+import time
+from array import array
+from collections import Counter
+from pathlib import Path
+
+from utils.format import print_table
+
+
+class RejectionCollector:
+    """
+    Collects why participants or some of their sections were rejected: the participant id, the section id
+    (None if the whole participant was rejected), the rule that rejected it and a detail message.
+
+    The rejections are kept in a compact table (one list or array per column, with each rule stored once),
+    and reported at the end (see print_summary, write_tsv and write_json).
+    With print_rejections, they are also printed as they come in, but at most lines_per_second of them per
+    second. The others are only counted, so a run with many rejections is not slowed down by its output.
+    """
+    def __init__(self, print_rejections=False, lines_per_second=10):
+        self.participant_ids = []
+        self.section_ids = []
+        self.rule_ids = array('H')
+        self.details = []
+        self.rules = []
+        self.rule_to_id = {}
+
+        self.print_rejections = print_rejections
+        self.lines_per_second = lines_per_second
+        self.num_not_printed = 0
+        self._print_budget = lines_per_second
+        self._budget_time = time.monotonic()
+
+    def add(self, participant_id: str, section_id, rule: str, detail: str):
+        rule_id = self.rule_to_id.get(rule)
+        if rule_id is None:
+            rule_id = self.rule_to_id[rule] = len(self.rules)
+            self.rules.append(rule)
+
+        self.participant_ids.append(participant_id)
+        self.section_ids.append(section_id)
+        self.rule_ids.append(rule_id)
+        self.details.append(detail)
+
+        if self.print_rejections:
+            self._print(participant_id, section_id, detail)
+
+    def _print(self, participant_id, section_id, detail):
+        now = time.monotonic()
+        self._print_budget = min(self.lines_per_second,
+                                 self._print_budget + (now - self._budget_time) * self.lines_per_second)
+        self._budget_time = now
+
+        if self._print_budget < 1:
+            self.num_not_printed += 1
+            return
+
+        self._print_budget -= 1
+        if section_id is None:
+            print(f'participant {participant_id} IGNORED: {detail}')
+        else:
+            print(f'participant {participant_id} SECTION {section_id} IGNORED: {detail}')
+
+    def __len__(self):
+        return len(self.rule_ids)
+
+    def __iter__(self):
+        """
+        (participant id, section id, rule, detail) of each rejection, in the order they were added.
+        """
+        rules = self.rules
+        for participant_id, section_id, rule_id, detail in zip(self.participant_ids, self.section_ids,
+                                                               self.rule_ids, self.details):
+            yield participant_id, section_id, rules[rule_id], detail
+
+    def counts_per_rule(self) -> dict[str, tuple[int, int]]:
+        """
+        For each rule, how many participants and how many sections it rejected (most rejections first).
+        """
+        participant_counts = Counter()
+        section_counts = Counter()
+        for section_id, rule_id in zip(self.section_ids, self.rule_ids):
+            if section_id is None:
+                participant_counts[rule_id] += 1
+            else:
+                section_counts[rule_id] += 1
+
+        counts = {self.rules[rule_id]: (participant_counts[rule_id], section_counts[rule_id])
+                  for rule_id in range(len(self.rules))}
+        return dict(sorted(counts.items(), key=lambda item: sum(item[1]), reverse=True))
+
+    def print_summary(self):
+        rows = [['Rule', 'Participants', 'Sections']]
+        rows += ([rule, num_participants, num_sections]
+                 for rule, (num_participants, num_sections) in self.counts_per_rule().items())
+        print_table(rows)
+
+        if self.num_not_printed:
+            print(f'{self.num_not_printed} rejections were not printed (see the report)')
+
+    def write_tsv(self, path: Path):
+        with path.open('w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file, delimiter='\t', lineterminator='\n')
+            writer.writerow(('PARTICIPANT_ID', 'SECTION_ID', 'RULE', 'DETAIL'))
+            for participant_id, section_id, rule, detail in self:
+                writer.writerow((participant_id, '' if section_id is None else section_id, rule, detail))
+
+    def write_json(self, path: Path):
+        path.write_text(json.dumps({
+            'counts': {rule: {'participants': num_participants, 'sections': num_sections}
+                       for rule, (num_participants, num_sections) in self.counts_per_rule().items()},
+            'rejections': list(self),
+        }, ensure_ascii=False), encoding='utf-8')
@@ -1,8 +1,67 @@
 import csv
+import ctypes
 import gzip
+import hashlib
+import io
+import json
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import deque
+from itertools import accumulate
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from csv import Dialect
 from pathlib import Path
 
+from utils.constants import TrainingEvent
+from utils.keys import KeyVocabulary, PAUSE_MARKER_KEY_ID
+
+EVENT_STORE_VERSION = 1
+EVENT_STORE_META_NAME = 'meta.json'
+
+# column name -> array typecode (int64 timestamps, uint8 down flags, uint16 key ids)
+EVENT_STORE_COLUMNS = {'time': 'q', 'down': 'B', 'key': 'H'}
+
+# Inflate and deflate csv.gz files in a background thread (see open_gz). zlib releases the GIL while it works,
+# so this overlaps with parsing or formatting the CSV.
+THREADED_GZIP = True
+GZIP_BLOCK_SIZE = 1 << 20
+# blocks that may be queued between the threads, which bounds the memory in between
+GZIP_MAX_QUEUED_BLOCKS = 8
+GZIP_COMPRESS_LEVEL = 9
+
+# Files written by BlockGzipWriter consist of gzip members of about this many uncompressed bytes each.
+# Their offsets are in a side index (path + GZIP_INDEX_SUFFIX), so readers can inflate them in parallel.
+GZIP_MEMBER_SIZE = 1 << 20
+GZIP_INDEX_SUFFIX = '.index'
+GZIP_INDEX_VERSION = 1
+GZIP_NUM_THREADS = os.cpu_count() or 1
+
+# FilePrefetcher reads whole files ahead of their parser in this many threads, as long as the files read but not
+# taken yet have at most PREFETCH_MAX_BYTES (and there are at most PREFETCH_MAX_QUEUED_FILES of them)
+PREFETCH_NUM_THREADS = 8
+PREFETCH_MAX_BYTES = 64 << 20
+PREFETCH_MAX_QUEUED_FILES = 256
+
+PARTICIPANT_INDEX_VERSION = 1
+CONVERSION_MANIFEST_VERSION = 3
+# number of events and length of the letters (JSON) at the start of an event block of the ConversionManifest
+EVENT_BLOCK_HEADER = struct.Struct('<II')
+
+TRAINING_EVENTS_MAGIC = b'TRAINEVT'
+TRAINING_EVENTS_VERSION = 1
+# magic, version, record size, record count, length of the JSON column layout that follows the header
+TRAINING_EVENTS_HEADER = struct.Struct('<8sIIQI')
+
+MAX_KEY_ID = (1 << (8 * array(EVENT_STORE_COLUMNS['key']).itemsize)) - 1
+
 
 class TabMinDialect(Dialect):
     delimiter = '\t'
@@ -30,11 +89,30 @@ def read_keylog_from_csv_gz(path: Path):
 
 
 def read_from_csv_gz(path: Path, process_reader):
-    with gzip.open(str(path), 'rt', newline='', encoding='utf-8') as file:
+    with open_gz(path, 'rt') as file:
         reader = csv.reader(file, dialect=TabMinDialect)
         return process_reader(reader)
 
 
+def iter_batches_from_csv_gz(path: Path, batch_size=1 << 16, split_at_pause_markers=False):
+    """
+    Yields the rows of path in lists of batch_size rows (the last one may be shorter), so only one batch
+    has to be in memory at a time.
+
+    With split_at_pause_markers, each batch ends with a pause marker row (empty key), or with the last row.
+    So a batch contains whole participants, and is only longer than batch_size if a single participant is.
+    """
+    with open_gz(path, 'rt') as file:
+        batch = []
+        for row in csv.reader(file, dialect=TabMinDialect):
+            batch.append(row)
+            if len(batch) >= batch_size and (not split_at_pause_markers or row[2] == ''):
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
 def write_items_to_csv_gz(path: Path, items):
     def wr(writer):
         for item in items:
@@ -44,6 +122,1071 @@ def write_items_to_csv_gz(path: Path, items):
 
 
 def write_to_csv_gz(path: Path, process_writer):
-    with gzip.open(str(path), 'wt', newline='', encoding='utf-8') as gz_file:
+    with open_gz(path, 'wt') as gz_file:
         writer = csv.writer(gz_file, dialect=TabMinDialect)
         process_writer(writer)
+
+
+def open_gz(path: Path, mode='rt', encoding='utf-8', newline=''):
+    """
+    Like gzip.open, but with THREADED_GZIP, inflating or deflating happens in a background thread
+    (see ThreadedGzipReader and ThreadedGzipWriter), and files with a member index (see BlockGzipWriter)
+    are inflated by several threads. Text modes default to UTF-8 without newline translation,
+    as the csv module needs.
+    """
+    if mode not in ('rt', 'wt', 'rb', 'wb'):
+        raise ValueError(f'unsupported mode: {mode}')
+
+    if not THREADED_GZIP:
+        if 'b' in mode:
+            return gzip.open(str(path), mode)
+        return gzip.open(str(path), mode, encoding=encoding, newline=newline)
+
+    if mode[0] == 'r':
+        members = read_gzip_index(path)
+        raw = ThreadedGzipReader(path) if members is None else ParallelGzipReader(path, members)
+        binary = io.BufferedReader(raw, GZIP_BLOCK_SIZE)
+    else:
+        gzip_index_path(path).unlink(missing_ok=True)
+        binary = io.BufferedWriter(ThreadedGzipWriter(path), GZIP_BLOCK_SIZE)
+
+    if 'b' in mode:
+        return binary
+    return io.TextIOWrapper(binary, encoding=encoding, newline=newline)
+
+
+class ThreadedGzipReader(io.RawIOBase):
+    """
+    Reads a gzip file (which may consist of several members, like the output of gzip or BGZF), while a background
+    thread reads and inflates it in blocks of GZIP_BLOCK_SIZE. At most GZIP_MAX_QUEUED_BLOCKS inflated blocks wait
+    in the queue between both threads.
+    """
+    def __init__(self, path: Path):
+        self._queue = queue.Queue(GZIP_MAX_QUEUED_BLOCKS)
+        self._stopped = threading.Event()
+        self._pending = memoryview(b'')
+        self._at_end = False
+        self._thread = threading.Thread(target=self._inflate, args=(path,), daemon=True)
+        self._thread.start()
+
+    def _inflate(self, path: Path):
+        try:
+            with open(path, 'rb') as file:
+                inflater = zlib.decompressobj(wbits=31)
+                in_member = False
+                while not self._stopped.is_set():
+                    block = file.read(GZIP_BLOCK_SIZE)
+                    if not block:
+                        break
+
+                    while block:
+                        in_member = True
+                        data = inflater.decompress(block)
+                        if data:
+                            self._put(data)
+
+                        block = b''
+                        if inflater.eof:
+                            # the next member starts after this one
+                            block = inflater.unused_data
+                            inflater = zlib.decompressobj(wbits=31)
+                            in_member = False
+
+                if in_member:
+                    raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+            self._put(b'')
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # gives up when the reader was closed, as nobody will take items from the queue anymore
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            if self._at_end:
+                return 0
+
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._at_end = True
+                raise item
+            if not item:
+                self._at_end = True
+                return 0
+            self._pending = memoryview(item)
+
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stopped.set()
+            self._thread.join()
+        super().close()
+
+
+class ThreadedGzipWriter(io.RawIOBase):
+    """
+    Writes a gzip file, while a background thread deflates the written blocks and writes them to the file.
+    At most GZIP_MAX_QUEUED_BLOCKS blocks wait in the queue between both threads.
+    """
+    def __init__(self, path: Path, compress_level=GZIP_COMPRESS_LEVEL):
+        self._file = open(path, 'wb')
+        self._queue = queue.Queue(GZIP_MAX_QUEUED_BLOCKS)
+        self._error = None
+        self._thread = threading.Thread(target=self._deflate, args=(compress_level,), daemon=True)
+        self._thread.start()
+
+    def _deflate(self, compress_level):
+        deflater = zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+        try:
+            while (block := self._queue.get()) is not None:
+                self._file.write(deflater.compress(block))
+            self._file.write(deflater.flush())
+        except Exception as e:
+            self._error = e
+            # keep taking blocks, so the writing thread does not block forever
+            while self._queue.get() is not None:
+                pass
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._raise_error()
+        self._queue.put(bytes(data))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._queue.put(None)
+            self._thread.join()
+            self._file.close()
+            super().close()
+            self._raise_error()
+
+
+def gzip_index_path(path: Path) -> Path:
+    return path.with_name(path.name + GZIP_INDEX_SUFFIX)
+
+
+def read_gzip_index(path: Path):
+    """
+    The members [(offset, compressed size, uncompressed size, number of rows), ...] of a file written by
+    BlockGzipWriter, or None if it has no index, or the index was not written together with the current file.
+    """
+    index_path = gzip_index_path(path)
+    if not index_path.exists() or not path.exists():
+        return None
+
+    index = json.loads(index_path.read_text())
+    if index.get('version') != GZIP_INDEX_VERSION or index.get('source') != source_fingerprint(path):
+        return None
+    return index['members']
+
+
+class BlockGzipWriter:
+    """
+    A text file for csv.writer, which writes path as a series of independent gzip members (like BGZF), each with
+    about GZIP_MEMBER_SIZE uncompressed bytes. The members are compressed in a thread pool.
+    Stock gzip / zcat read it like any other gzip file.
+
+    A member only ends after a complete row (each write must consist of whole rows, like the writes of
+    csv.writer). With split_at_pause_markers, it only ends after a row with an empty last column (the pause
+    markers), so each member contains whole participants.
+
+    When closed, the offsets and sizes of the members are written to the index next to path (see read_gzip_index).
+    With replace, the file is written to a temporary file next to path, which only replaces path when closed
+    after a complete write, so an interrupted write leaves the previous file as it was.
+    """
+    def __init__(self, path: Path, split_at_pause_markers=False, member_size=GZIP_MEMBER_SIZE,
+                 compress_level=GZIP_COMPRESS_LEVEL, num_threads=GZIP_NUM_THREADS, replace=False):
+        self.path = path
+        self.split_at_pause_markers = split_at_pause_markers
+        self.member_size = member_size
+        self.compress_level = compress_level
+
+        if replace:
+            self.write_path = path.with_name(path.name + '.tmp')
+        else:
+            self.write_path = path
+            # an index of a previous file must not be used for this one
+            gzip_index_path(path).unlink(missing_ok=True)
+        self.file = self.write_path.open('wb')
+        self.offset = 0
+        self.members = []
+
+        self.parts = []
+        self.num_chars = 0
+        self.num_rows = 0
+
+        self.executor = ThreadPoolExecutor(num_threads)
+        self.max_pending = 2 * num_threads
+        self.pending = deque()
+
+    def write(self, text: str):
+        self.parts.append(text)
+        self.num_chars += len(text)
+        self.num_rows += text.count('\n')
+
+        if self.num_chars >= self.member_size and (not self.split_at_pause_markers or text.endswith('\t\n')):
+            self.end_member()
+        return len(text)
+
+    def end_member(self):
+        if not self.parts:
+            return
+
+        data = ''.join(self.parts).encode('utf-8')
+        future = self.executor.submit(gzip.compress, data, self.compress_level, mtime=0)
+        self.pending.append((future, len(data), self.num_rows))
+        self.parts = []
+        self.num_chars = 0
+        self.num_rows = 0
+
+        while len(self.pending) > self.max_pending:
+            self._write_next_member()
+
+    def _write_next_member(self):
+        future, size, num_rows = self.pending.popleft()
+        member = future.result()
+        self.file.write(member)
+        self.members.append((self.offset, len(member), size, num_rows))
+        self.offset += len(member)
+
+    def close(self, write_index=True):
+        if self.file.closed:
+            return
+
+        try:
+            if write_index:
+                self.end_member()
+                while self.pending:
+                    self._write_next_member()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            self.file.close()
+
+        if not write_index:
+            if self.write_path != self.path:
+                self.write_path.unlink()
+            return
+
+        if self.write_path != self.path:
+            # the index of the previous file does not match the new one (see read_gzip_index)
+            os.replace(self.write_path, self.path)
+        gzip_index_path(self.path).write_text(json.dumps({
+            'version': GZIP_INDEX_VERSION,
+            'source': source_fingerprint(self.path),
+            'members': self.members,
+        }))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(write_index=exc_type is None)
+
+
+class ParallelGzipReader(io.RawIOBase):
+    """
+    Reads a file written by BlockGzipWriter: its members (see read_gzip_index) are inflated by a thread pool,
+    with at most GZIP_MAX_QUEUED_BLOCKS of them in flight, and returned in order.
+    """
+    def __init__(self, path: Path, members, num_threads=GZIP_NUM_THREADS):
+        self._file = path.open('rb')
+        self._members = iter(members)
+        self._executor = ThreadPoolExecutor(num_threads)
+        self._inflating = deque()
+        self._pending = memoryview(b'')
+        self._fill()
+
+    def _fill(self):
+        while len(self._inflating) < GZIP_MAX_QUEUED_BLOCKS:
+            member = next(self._members, None)
+            if member is None:
+                return
+
+            offset, compressed_size, size, _ = member
+            self._file.seek(offset)
+            data = self._file.read(compressed_size)
+            if len(data) != compressed_size:
+                raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+            self._inflating.append((self._executor.submit(zlib.decompress, data, 31), size))
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            if not self._inflating:
+                return 0
+
+            future, size = self._inflating.popleft()
+            data = future.result()
+            if len(data) != size:
+                raise ValueError(f'a member of {self._file.name} has {len(data)} instead of {size} bytes')
+            self._pending = memoryview(data)
+            self._fill()
+
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown(cancel_futures=True)
+            self._file.close()
+        super().close()
+
+
+class FilePrefetcher:
+    """
+    Reads whole files on a thread pool ahead of their consumer, which gets (path, data) in the order of paths.
+    This hides the latency of opening and reading each file (e.g. on network storage or a cold disk).
+
+    A file is only read when its size fits into max_bytes together with the files that are read or being read,
+    but were not taken yet. The next file to be taken is always read, so a larger file cannot block.
+    """
+    def __init__(self, paths, num_threads=PREFETCH_NUM_THREADS, max_bytes=PREFETCH_MAX_BYTES,
+                 max_queued_files=PREFETCH_MAX_QUEUED_FILES):
+        self.max_bytes = max_bytes
+        self.max_queued_files = max_queued_files
+        self._paths = enumerate(paths)
+        self._executor = ThreadPoolExecutor(num_threads)
+        self._reading = deque()
+        self._condition = threading.Condition()
+        self._num_bytes = 0
+        self._next_index = 0
+        self._closed = False
+
+    def _read(self, index, path: Path):
+        # runs in the pool, which starts the reads in order, so the next file to be taken is never left waiting
+        # for a thread while later files wait for memory
+        size = path.stat().st_size
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or index == self._next_index
+                                     or self._num_bytes + size <= self.max_bytes)
+            self._num_bytes += size
+
+        try:
+            return size, path.read_bytes()
+        except BaseException:
+            self._release(size)
+            raise
+
+    def _release(self, size):
+        with self._condition:
+            self._num_bytes -= size
+            self._condition.notify_all()
+
+    def _fill(self):
+        while len(self._reading) < self.max_queued_files:
+            index, path = next(self._paths, (None, None))
+            if path is None:
+                return
+            self._reading.append((path, self._executor.submit(self._read, index, path)))
+
+    def __iter__(self):
+        self._fill()
+        while self._reading:
+            path, future = self._reading.popleft()
+            try:
+                size, data = future.result()
+            finally:
+                with self._condition:
+                    self._next_index += 1
+                    self._condition.notify_all()
+            self._release(size)
+            self._fill()
+            yield path, data
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ParticipantIndex:
+    """
+    Where the events of each participant are in a file written by BlockGzipWriter, so they can be read without
+    inflating the whole file (see read).
+
+    For each participant id, it has the row range of its events (without the pause marker after them),
+    their first and last timestamp, and an access point like those of zran: the offset and compressed size of
+    the gzip member the events start in, and the number of rows of the member before them.
+    As the members are independent, no inflate window has to be stored.
+    """
+    def __init__(self, path: Path, participants: dict):
+        self.path = path
+        self.participants = participants
+
+    @classmethod
+    def build(cls, path: Path, participant_rows) -> 'ParticipantIndex':
+        """
+        Builds the index from (participant id, first row, number of rows, first timestamp, last timestamp)
+        tuples and the member index of path (see read_gzip_index), so path must be closed already.
+        """
+        members = read_gzip_index(path)
+        if members is None:
+            raise ValueError(f'{path.name} has no gzip member index')
+
+        member_first_rows = list(accumulate((m[3] for m in members), initial=0))
+        participants = {}
+        for participant_id, first_row, num_rows, first_t, last_t in participant_rows:
+            i = bisect_right(member_first_rows, first_row) - 1
+            offset, compressed_size, _, _ = members[i]
+            participants[participant_id] = {
+                'rows': [first_row, num_rows],
+                'time': [first_t, last_t],
+                'checkpoint': [offset, compressed_size, first_row - member_first_rows[i]],
+            }
+        return cls(path, participants)
+
+    @classmethod
+    def load(cls, index_path: Path, path: Path):
+        """
+        The index saved at index_path, or None if there is none, or it was not written together with path.
+        """
+        if not index_path.exists() or not path.exists():
+            return None
+
+        index = json.loads(index_path.read_text())
+        if index.get('version') != PARTICIPANT_INDEX_VERSION or index.get('source') != source_fingerprint(path):
+            return None
+        return cls(path, index['participants'])
+
+    def save(self, index_path: Path):
+        index_path.write_text(json.dumps({
+            'version': PARTICIPANT_INDEX_VERSION,
+            'source': source_fingerprint(self.path),
+            'participants': self.participants,
+        }))
+
+    def __contains__(self, participant_id):
+        return participant_id in self.participants
+
+    def __iter__(self):
+        return iter(self.participants)
+
+    def __len__(self):
+        return len(self.participants)
+
+    def read(self, participant_ids) -> dict[str, list[list[str]]]:
+        """
+        The rows of the events of each given participant, like read_from_csv_gz would give them.
+        Only the members which contain them are inflated.
+        """
+        members = read_gzip_index(self.path)
+        if members is None:
+            raise ValueError(f'{self.path.name} was changed after its participant index was written')
+        member_offsets = [m[0] for m in members]
+
+        result = {}
+        inflated = {}
+        with self.path.open('rb') as file:
+            def member_lines(i):
+                if i not in inflated:
+                    offset, compressed_size, _, _ = members[i]
+                    file.seek(offset)
+                    text = zlib.decompress(file.read(compressed_size), 31).decode('utf-8')
+                    inflated[i] = text.splitlines()
+                return inflated[i]
+
+            for participant_id in participant_ids:
+                participant = self.participants[participant_id]
+                _, num_rows = participant['rows']
+                offset, _, skip = participant['checkpoint']
+
+                i = bisect_right(member_offsets, offset) - 1
+                lines = member_lines(i)[skip:skip + num_rows]
+                while len(lines) < num_rows:
+                    i += 1
+                    lines += member_lines(i)[:num_rows - len(lines)]
+
+                result[participant_id] = list(csv.reader(lines, dialect=TabMinDialect))
+        return result
+
+
+class MultiWriter:
+    """
+    Forwards each row to all the given writers. num_rows counts the rows that were written to all of them.
+    """
+    def __init__(self, *writers):
+        self.writers = writers
+        self.num_rows = 0
+
+    def writerow(self, row):
+        for writer in self.writers:
+            writer.writerow(row)
+        self.num_rows += 1
+
+
+class EventStoreWriter:
+    """
+    Writes (timestamp, down, key) rows into a directory with one raw binary file per column and a meta.json,
+    which contains the keys of the vocabulary. The key ids are the ids of the given vocabulary (which gets
+    new keys added), so stores written with the same persisted vocabulary share their ids.
+    Rows with the key None (the pause markers) get the key id 0.
+
+    Has the same writerow method as a csv writer. The store is only valid after close() was called.
+    If source_path is given, its size and modification time (and with hash_source its content hash) are
+    recorded when closing, so a reader can check that the store still matches the source (see is_event_store_of).
+    """
+    def __init__(self, path: Path, source_path: Path = None, hash_source=False, flush_every=1 << 16,
+                 vocabulary: KeyVocabulary = None):
+        self.path = path
+        self.source_path = source_path
+        self.hash_source = hash_source
+        self.flush_every = flush_every
+        self.count = 0
+        self.vocabulary = KeyVocabulary() if vocabulary is None else vocabulary
+        self.key_to_id = self.vocabulary.key_to_id
+        self.markers = []
+
+        path.mkdir(parents=True, exist_ok=True)
+        # an interrupted write must not leave a valid looking store behind
+        (path / EVENT_STORE_META_NAME).unlink(missing_ok=True)
+
+        self.columns = {name: array(typecode) for name, typecode in EVENT_STORE_COLUMNS.items()}
+        self.files = {name: (path / f'{name}.bin').open('wb') for name in EVENT_STORE_COLUMNS}
+
+    def writerow(self, row):
+        t, down, key = row
+
+        if key is None:
+            key_id = PAUSE_MARKER_KEY_ID
+            self.markers.append(self.count)
+        else:
+            key_id = self.key_to_id.get(key)
+            if key_id is None:
+                key_id = self.vocabulary.id_of(key)
+                if key_id > MAX_KEY_ID:
+                    raise ValueError(f'cannot store more than {MAX_KEY_ID} different keys')
+
+        self.columns['time'].append(t)
+        self.columns['down'].append(1 if down else 0)
+        self.columns['key'].append(key_id)
+        self.count += 1
+
+        if len(self.columns['time']) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        for name, column in self.columns.items():
+            column.tofile(self.files[name])
+            del column[:]
+
+    def close(self, write_meta=True):
+        self.flush()
+        for file in self.files.values():
+            file.close()
+
+        if not write_meta:
+            return
+
+        (self.path / EVENT_STORE_META_NAME).write_text(json.dumps({
+            'version': EVENT_STORE_VERSION,
+            'byteorder': sys.byteorder,
+            'count': self.count,
+            'keys': self.vocabulary.keys,
+            'markers': self.markers,
+            'source': None if self.source_path is None else source_fingerprint(self.source_path, self.hash_source),
+        }))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(write_meta=exc_type is None)
+
+
+def file_hash(path: Path) -> str:
+    with path.open('rb') as file:
+        return hashlib.file_digest(file, 'blake2b').hexdigest()
+
+
+def bytes_hash(data: bytes) -> str:
+    """
+    The same as file_hash for a file with this content.
+    """
+    return hashlib.blake2b(data).hexdigest()
+
+
+def source_fingerprint(path: Path, with_hash=False) -> dict:
+    stat = path.stat()
+    fingerprint = {'name': path.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        fingerprint['blake2b'] = file_hash(path)
+    return fingerprint
+
+
+def is_event_store_of(path: Path, source_path: Path, with_hash=False) -> bool:
+    """
+    True if a complete store exists at path and was written together with source_path in its current version.
+    With with_hash, the content of source_path must also still have the recorded hash.
+    """
+    meta_path = path / EVENT_STORE_META_NAME
+    if not meta_path.exists() or not source_path.exists():
+        return False
+
+    recorded = json.loads(meta_path.read_text()).get('source')
+    if not recorded:
+        return False
+
+    # compare the cheap parts first, so the file is only hashed if it may not have changed
+    if any(recorded.get(k) != v for k, v in source_fingerprint(source_path).items()):
+        return False
+    return not with_hash or recorded.get('blake2b') == file_hash(source_path)
+
+
+class ConversionManifest:
+    """
+    Records for each participant file the converter checked: its size, mtime and hash, the settings it was
+    checked with, the rejections of it or its sections, its features (whatever the converter compares with its
+    cut-offs), whether it was used in the last run (or why it was not), and where its checked events are in the
+    block file at blocks_path (see encode_event_block, appended as they come in).
+
+    So a re-run only has to parse new or changed files (see lookup), and the output can be reassembled from the
+    blocks, also with other cut-offs. save() is called every save_every recorded files and when closing (also
+    after an exception), so an interrupted run continues with the files recorded until then.
+    """
+    def __init__(self, path: Path, blocks_path: Path, save_every=1000):
+        self.path = path
+        self.blocks_path = blocks_path
+        self.save_every = save_every
+
+        self.entries = {}
+        if path.exists() and blocks_path.exists():
+            manifest = json.loads(path.read_text(encoding='utf-8'))
+            if manifest.get('version') == CONVERSION_MANIFEST_VERSION:
+                self.entries = manifest['files']
+        self.seen = set()
+        self.num_unsaved = 0
+
+        # blocks appended after the last save belong to no entry
+        end = max((sum(entry['block']) for entry in self.entries.values() if entry['block']), default=0)
+        self.blocks_file = blocks_path.open('r+b' if blocks_path.exists() else 'w+b')
+        self.blocks_file.truncate(end)
+        self.blocks_file.seek(end)
+
+    def lookup(self, path: Path, settings: dict):
+        """
+        The entry of path, if it was recorded with the same settings and the file did not change since:
+        it must have the same size and mtime, or, if only the mtime differs, the same hash.
+        """
+        self.seen.add(path.name)
+        entry = self.entries.get(path.name)
+        if entry is None or entry['settings'] != settings:
+            return None
+
+        fingerprint = source_fingerprint(path)
+        if fingerprint['size'] != entry['size']:
+            return None
+        if fingerprint['mtime_ns'] != entry['mtime_ns']:
+            if file_hash(path) != entry['blake2b']:
+                return None
+            entry['mtime_ns'] = fingerprint['mtime_ns']
+            self.num_unsaved += 1
+        return entry
+
+    def record(self, path: Path, settings: dict, blake2b: str, events, rejections: list, features: dict) -> dict:
+        """
+        Records the result of checking path: events is None if it can never be used.
+        """
+        block = None
+        if events is not None:
+            data = encode_event_block(events)
+            block = [self.blocks_file.tell(), len(data)]
+            self.blocks_file.write(data)
+
+        stat = path.stat()
+        entry = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'blake2b': blake2b,
+            'settings': settings,
+            'verdict': None,
+            'reason': None,
+            'rejections': rejections,
+            'features': features,
+            'block': block,
+        }
+        self.seen.add(path.name)
+        self.entries[path.name] = entry
+
+        self.num_unsaved += 1
+        if self.num_unsaved >= self.save_every:
+            self.save()
+        return entry
+
+    def set_verdict(self, entry: dict, used: bool, reason=None):
+        """
+        Records whether the file of entry was used in this run, or why it was not (if there is a reason).
+        """
+        verdict = 'used' if used else 'ignored'
+        if (entry['verdict'], entry['reason']) != (verdict, reason):
+            entry['verdict'] = verdict
+            entry['reason'] = reason
+            self.num_unsaved += 1
+
+    def read_events(self, entry: dict):
+        """
+        The events recorded for entry, or None if it has none.
+        """
+        if entry['block'] is None:
+            return None
+
+        offset, size = entry['block']
+        self.blocks_file.seek(offset)
+        events = decode_event_block(self.blocks_file.read(size))
+        self.blocks_file.seek(0, os.SEEK_END)
+        return events
+
+    def save(self):
+        self.blocks_file.flush()
+        # written to a temporary file first, so an interruption cannot leave a partial manifest
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        tmp_path.write_text(json.dumps({
+            'version': CONVERSION_MANIFEST_VERSION,
+            'files': self.entries,
+        }, ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp_path, self.path)
+        self.num_unsaved = 0
+
+    def close(self, completed=True):
+        """
+        Saves the manifest. If the run was completed, the entries of files which were not looked up or
+        recorded in it are dropped, and the block file is compacted once most of it is unused.
+        """
+        if self.blocks_file.closed:
+            return
+
+        if completed:
+            self.entries = {name: entry for name, entry in self.entries.items() if name in self.seen}
+            used = sum(entry['block'][1] for entry in self.entries.values() if entry['block'])
+            if 2 * used < self.blocks_file.seek(0, os.SEEK_END):
+                self._compact()
+        self.save()
+        self.blocks_file.close()
+
+    def _compact(self):
+        tmp_path = self.blocks_path.with_name(self.blocks_path.name + '.tmp')
+        with tmp_path.open('wb') as tmp_file:
+            for entry in self.entries.values():
+                if entry['block']:
+                    offset, size = entry['block']
+                    self.blocks_file.seek(offset)
+                    entry['block'] = [tmp_file.tell(), size]
+                    tmp_file.write(self.blocks_file.read(size))
+
+        # the saved manifest points into the old block file, so it is removed before it is replaced
+        # (if the run is interrupted in between, all files are parsed again)
+        self.path.unlink(missing_ok=True)
+        self.blocks_file.close()
+        os.replace(tmp_path, self.blocks_path)
+        self.blocks_file = self.blocks_path.open('r+b')
+        self.blocks_file.seek(0, os.SEEK_END)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(completed=exc_type is None)
+
+
+def encode_event_block(events) -> bytes:
+    """
+    The zlib-compressed binary form of [time, down, letter] events: EVENT_BLOCK_HEADER, the distinct letters
+    as JSON, and then the columns as arrays (int64 times, uint8 down flags and uint32 letter indices).
+    """
+    letter_to_index = {}
+    times = array('q')
+    downs = array('B')
+    letter_indices = array('I')
+    for t, down, letter in events:
+        times.append(t)
+        downs.append(down)
+        index = letter_to_index.get(letter)
+        if index is None:
+            index = letter_to_index[letter] = len(letter_to_index)
+        letter_indices.append(index)
+
+    letters = json.dumps(list(letter_to_index), ensure_ascii=False).encode('utf-8')
+    return zlib.compress(b''.join((EVENT_BLOCK_HEADER.pack(len(times), len(letters)), letters,
+                                   times.tobytes(), downs.tobytes(), letter_indices.tobytes())))
+
+
+def decode_event_block(data: bytes) -> list[list]:
+    data = zlib.decompress(data)
+    num_events, letters_size = EVENT_BLOCK_HEADER.unpack_from(data)
+    offset = EVENT_BLOCK_HEADER.size
+    letters = json.loads(data[offset:offset + letters_size])
+    offset += letters_size
+
+    columns = []
+    for typecode in 'qBI':
+        column = array(typecode)
+        end = offset + num_events * column.itemsize
+        column.frombytes(data[offset:end])
+        columns.append(column)
+        offset = end
+
+    times, downs, letter_indices = columns
+    return [[t, down, letters[i]] for t, down, i in zip(times, downs, letter_indices)]
+
+
+class EventStore(Sequence):
+    """
+    Memory-maps a store written by EventStoreWriter.
+
+    The columns are available as memoryviews (times, downs, key_ids), keys maps a key id to the key.
+    Indexing returns the same rows as read_keylog_from_csv_gz: (timestamp, 1 / 0 / None, key / None)
+    """
+    def __init__(self, path: Path):
+        meta = json.loads((path / EVENT_STORE_META_NAME).read_text())
+        if meta['version'] != EVENT_STORE_VERSION:
+            raise ValueError(f'{path} has version {meta["version"]}, but expected {EVENT_STORE_VERSION}')
+        if meta['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was written on a {meta["byteorder"]} endian machine')
+
+        self.path = path
+        self.count = meta['count']
+        self.markers = meta['markers']
+        self.keys = [sys.intern(k) for k in meta['keys']]
+
+        self._mmaps = []
+        self.times = self._map_column('time')
+        self.downs = self._map_column('down')
+        self.key_ids = self._map_column('key')
+
+    def _map_column(self, name):
+        typecode = EVENT_STORE_COLUMNS[name]
+        if self.count == 0:
+            # empty files cannot be memory-mapped
+            return memoryview(array(typecode))
+
+        with (self.path / f'{name}.bin').open('rb') as file:
+            mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmaps.append(mm)
+
+        column = memoryview(mm).cast(typecode)
+        if len(column) != self.count:
+            raise ValueError(f'{name} column of {self.path} has {len(column)} instead of {self.count} rows')
+        return column
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+
+        key_id = self.key_ids[i]
+        if key_id == PAUSE_MARKER_KEY_ID:
+            return self.times[i], None, None
+        return self.times[i], self.downs[i], self.keys[key_id]
+
+    def without_pause_markers(self, with_key_ids=False):
+        return EventStoreView(self, with_key_ids)
+
+    def close(self):
+        for column in (self.times, self.downs, self.key_ids):
+            column.release()
+        for mm in self._mmaps:
+            mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class EventStoreView(Sequence):
+    """
+    The events of an EventStore as (timestamp, is_down, key) tuples with the pause markers skipped.
+    With with_key_ids, the key ids are returned instead of the keys (see store.keys and utils.keys.KeyTables).
+    """
+    def __init__(self, store: EventStore, with_key_ids=False):
+        self.store = store
+        self.with_key_ids = with_key_ids
+        # i-th marker is skipped by all view indexes >= marker_gaps[i]
+        self.marker_gaps = [m - i for i, m in enumerate(store.markers)]
+        self.count = store.count - len(store.markers)
+
+    def __len__(self):
+        return self.count
+
+    def store_index(self, i: int):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('event index out of range')
+        return i + bisect_right(self.marker_gaps, i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+
+        j = self.store_index(i)
+        store = self.store
+        key_id = store.key_ids[j]
+        return store.times[j], store.downs[j] == 1, key_id if self.with_key_ids else store.keys[key_id]
+
+    def __iter__(self):
+        store = self.store
+        keys = store.keys
+        start = 0
+        for end in store.markers + [store.count]:
+            rows = zip(store.times[start:end], store.downs[start:end], store.key_ids[start:end])
+            if self.with_key_ids:
+                for t, down, key_id in rows:
+                    yield t, down == 1, key_id
+            else:
+                for t, down, key_id in rows:
+                    yield t, down == 1, keys[key_id]
+            start = end + 1
+
+    def indexes_before_pause_markers(self):
+        """
+        For each pause marker, the view index of the event before it (None if there is none).
+        """
+        return [gap - 1 if gap > 0 else None for gap in self.marker_gaps]
+
+
+def training_event_layout() -> list[dict]:
+    return [
+        {'name': name, 'type': c_type.__name__, 'offset': getattr(TrainingEvent, name).offset}
+        for name, c_type in TrainingEvent._fields_
+    ]
+
+
+def write_training_events(path: Path, elements, batch_size=1 << 16, replace=False):
+    """
+    Writes the elements (tuples in the order of TrainingDataColId) as one contiguous array of TrainingEvent,
+    after a small header with the version, the count and the column layout. See TrainingEventsWriter for replace.
+    """
+    with TrainingEventsWriter(path, batch_size, replace) as writer:
+        writer.write(elements)
+
+
+class TrainingEventsWriter:
+    """
+    Writes the file of write_training_events incrementally: each call of write appends elements, which are
+    buffered and written in batches of batch_size. The header is written when closing, so an interrupted
+    write does not leave a valid file behind.
+    With replace, the file is written to a temporary file next to path, which only replaces path when closed
+    after a complete write, so an interrupted write leaves the previous file as it was.
+    """
+    def __init__(self, path: Path, batch_size=1 << 16, replace=False):
+        self.path = path
+        self.write_path = path.with_name(path.name + '.tmp') if replace else path
+        self.batch_size = batch_size
+        self.count = 0
+        self.batch = []
+
+        self.layout = json.dumps(training_event_layout()).encode('utf-8')
+        header_size = TRAINING_EVENTS_HEADER.size + len(self.layout)
+        # the records start 8 byte aligned, so they can be used in place
+        padding = -header_size % ctypes.alignment(TrainingEvent)
+
+        self.file = self.write_path.open('wb')
+        self.file.write(TRAINING_EVENTS_HEADER.pack(b'', 0, 0, 0, 0))
+        self.file.write(self.layout)
+        self.file.write(b'\0' * padding)
+
+    def write(self, elements):
+        batch = self.batch
+        for el in elements:
+            batch.append(TrainingEvent(*el))
+            if len(batch) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.file.write((TrainingEvent * len(self.batch))(*self.batch))
+            self.count += len(self.batch)
+            self.batch.clear()
+
+    def close(self, write_header=True):
+        if write_header:
+            self.flush()
+            self.file.seek(0)
+            self.file.write(TRAINING_EVENTS_HEADER.pack(
+                TRAINING_EVENTS_MAGIC, TRAINING_EVENTS_VERSION, ctypes.sizeof(TrainingEvent), self.count,
+                len(self.layout)))
+        self.file.close()
+
+        if self.write_path != self.path:
+            if write_header:
+                os.replace(self.write_path, self.path)
+            else:
+                self.write_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(write_header=exc_type is None)
+
+
+class TrainingEventsFile:
+    """
+    Memory-maps a file written by write_training_events. events is a ctypes array of TrainingEvent
+    (with NumPy, numpy.ctypeslib.as_array(events) gives a structured array without copying).
+
+    The mapping is copy-on-write, so changes to events are not written back to the file.
+    """
+    def __init__(self, path: Path):
+        with path.open('rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        magic, version, record_size, count, layout_size = TRAINING_EVENTS_HEADER.unpack_from(self._mmap)
+        if magic != TRAINING_EVENTS_MAGIC:
+            raise ValueError(f'{path} is not a training events file')
+        if version != TRAINING_EVENTS_VERSION:
+            raise ValueError(f'{path} has version {version}, but expected {TRAINING_EVENTS_VERSION}')
+
+        offset = TRAINING_EVENTS_HEADER.size
+        layout = json.loads(self._mmap[offset:offset + layout_size])
+        if record_size != ctypes.sizeof(TrainingEvent) or layout != training_event_layout():
+            raise ValueError(f'{path} has a different column layout than TrainingEvent: {layout}')
+
+        offset += layout_size
+        offset += -offset % ctypes.alignment(TrainingEvent)
+        self.count = count
+        self.events = (TrainingEvent * count).from_buffer(self._mmap, offset)
+
+    def close(self):
+        del self.events
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
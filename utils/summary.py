@@ -0,0 +1,275 @@
+import math
+from array import array
+from collections import Counter
+from collections.abc import Iterable
+
+# Integers in (-EXACT_LIMIT, EXACT_LIMIT) are counted exactly by QuantileSketch.
+# Durations in ms fit, as the converter drops key presses longer than 7 seconds.
+EXACT_LIMIT = 1 << 13
+
+INTEGER_TYPECODES = set('bBhHiIlLqQ')
+
+
+class Summary:
+    """
+    Base of the mergeable summaries used by print_stats.
+
+    Subclasses implement add, merge and value_at. The quantiles are interpolated exactly like they were
+    computed from a sorted list, so ExactSummary gives the same results as sorting all values.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def add_all(self, values: Iterable):
+        for value in values:
+            self.add(value)
+        return self
+
+    def _add_to_totals(self, value):
+        if self.count == 0:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+
+        self.count += 1
+        self.total += value
+
+    def _merge_totals(self, other: 'Summary'):
+        self._add_many_to_totals(other.count, other.total, other.min, other.max)
+
+    def _add_many_to_totals(self, count, total, low, high):
+        if not count:
+            return
+
+        if self.count == 0:
+            self.min = low
+            self.max = high
+        else:
+            self.min = min(self.min, low)
+            self.max = max(self.max, high)
+
+        self.count += count
+        self.total += total
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    def median(self):
+        mid = self.count // 2
+        if self.count > 1 and self.count % 2 == 0:
+            return (self.value_at(mid - 1) + self.value_at(mid)) / 2
+        return self.value_at(mid)
+
+    def quantile(self, q):
+        """
+        The value below which q of all values are (with linear interpolation between neighbours).
+        """
+        i = self.count * q
+        rem = i - int(i)
+        j = min(int(i) + 1, self.count - 1)
+        return self.value_at(int(i)) * (1 - rem) + self.value_at(j) * rem
+
+    def add(self, value):
+        raise NotImplementedError
+
+    def merge(self, other):
+        raise NotImplementedError
+
+    def value_at(self, rank):
+        """
+        The rank-th smallest value (starting at 0).
+        """
+        raise NotImplementedError
+
+
+class ExactSummary(Summary):
+    """
+    Keeps every value, so memory grows with the number of values. Used to check QuantileSketch.
+    """
+    def __init__(self, values: Iterable = ()):
+        super().__init__()
+        self.values = []
+        self._sorted = None
+        self.add_all(values)
+
+    def add(self, value):
+        self.values.append(value)
+        self._sorted = None
+        self._add_to_totals(value)
+
+    def add_all(self, values: Iterable):
+        if isinstance(values, array):
+            if values:
+                self.values.extend(values)
+                self._sorted = None
+                self._add_many_to_totals(len(values), sum(values), min(values), max(values))
+            return self
+        return super().add_all(values)
+
+    def merge(self, other: 'ExactSummary'):
+        self.values.extend(other.values)
+        self._sorted = None
+        self._merge_totals(other)
+        return self
+
+    @property
+    def mean(self):
+        # sum in sorted order, so the result does not depend on the order the values were added in
+        return sum(self._sorted_values()) / self.count
+
+    def value_at(self, rank):
+        return self._sorted_values()[rank]
+
+    def _sorted_values(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.values)
+        return self._sorted
+
+
+class QuantileSketch(Summary):
+    """
+    Streaming summary with bounded memory, which can be merged with other sketches.
+
+    min, max, count and mean are exact. Small integers (like durations in ms) are counted exactly as well.
+    All other values go into logarithmic buckets (like a DDSketch), so each quantile computed from them
+    has a relative error of at most relative_accuracy.
+
+    Memory does not grow with the number of values: a sketch holds at most 2 * EXACT_LIMIT exact counts,
+    plus about log(max / min) / log(gamma) buckets per sign (~2_800 for values between 1e-6 and 1e6).
+    """
+    def __init__(self, relative_accuracy=0.005):
+        super().__init__()
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        self.exact = Counter()
+        self.positive_buckets = Counter()
+        self.negative_buckets = Counter()
+        self._sorted = None
+
+    def add(self, value):
+        self._add_to_totals(value)
+        self._sorted = None
+
+        if -EXACT_LIMIT < value < EXACT_LIMIT and value == int(value):
+            self.exact[int(value)] += 1
+        elif value > 0:
+            self.positive_buckets[math.ceil(math.log(value) / self.log_gamma)] += 1
+        else:
+            self.negative_buckets[math.ceil(math.log(-value) / self.log_gamma)] += 1
+
+    def add_all(self, values: Iterable):
+        # an array of integers that can all be counted exactly is added without a loop in Python
+        if isinstance(values, array) and values.typecode in INTEGER_TYPECODES:
+            if not values:
+                return self
+
+            low = min(values)
+            high = max(values)
+            if -EXACT_LIMIT < low and high < EXACT_LIMIT:
+                self._add_many_to_totals(len(values), sum(values), low, high)
+                self.exact.update(values)
+                self._sorted = None
+                return self
+        return super().add_all(values)
+
+    def merge(self, other: 'QuantileSketch'):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('can only merge sketches with the same relative accuracy')
+
+        self.exact.update(other.exact)
+        self.positive_buckets.update(other.positive_buckets)
+        self.negative_buckets.update(other.negative_buckets)
+        self._sorted = None
+        self._merge_totals(other)
+        return self
+
+    def _bucket_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def value_at(self, rank):
+        if not 0 <= rank < self.count:
+            raise IndexError('rank out of range')
+
+        seen = 0
+        for value, count in self._sorted_counts():
+            seen += count
+            if rank < seen:
+                # the bucket value may be slightly outside the actual range
+                return min(max(value, self.min), self.max)
+
+    def _sorted_counts(self):
+        if self._sorted is None:
+            counts = list(self.exact.items())
+            counts += ((-self._bucket_value(i), c) for i, c in self.negative_buckets.items())
+            counts += ((self._bucket_value(i), c) for i, c in self.positive_buckets.items())
+            counts.sort()
+            self._sorted = counts
+        return self._sorted
+
+
+if __name__ == '__main__':
+    import random
+
+    rnd = random.Random(0)
+
+    def results(summary: Summary):
+        return summary.min, summary.max, summary.mean, summary.median(), summary.quantile(0.99)
+
+    # integer durations are exact
+    durations = [rnd.randint(-1500, 7000) for _ in range(50_000)]
+    exact = results(ExactSummary(durations))
+    sketched = results(QuantileSketch().add_all(durations))
+    if exact != sketched:
+        print(f"FAILED: integer durations {sketched} vs {exact}")
+
+    # floats (like the overlap percentages) are within the relative accuracy
+    percentages = [100 * rnd.random() ** 3 for _ in range(50_000)] + [-rnd.expovariate(0.1) for _ in range(5_000)]
+    exact_summary = ExactSummary(percentages)
+    sketch = QuantileSketch().add_all(percentages)
+    for q in (0.01, 0.1, 0.5, 0.9, 0.99):
+        e = exact_summary.quantile(q)
+        a = sketch.quantile(q)
+        if abs(a - e) > sketch.relative_accuracy * abs(e):
+            print(f"FAILED: quantile {q} is {a}, but should be within {sketch.relative_accuracy:.1%} of {e}")
+
+    # adding an array at once is the same as adding each value
+    for typecode, values in (('q', durations), ('q', [0, EXACT_LIMIT, -EXACT_LIMIT]), ('d', percentages)):
+        for summary_type in (ExactSummary, QuantileSketch):
+            bulk = results(summary_type().add_all(array(typecode, values)))
+            single = summary_type()
+            for value in values:
+                single.add(value)
+            if bulk != results(single):
+                print(f"FAILED: adding an array to {summary_type.__name__} gives {bulk} instead of {results(single)}")
+
+    # merging gives the same result in any order
+    values = durations + percentages
+    parts = [values[i:i + 7_000] for i in range(0, len(values), 7_000)]
+    forward = QuantileSketch()
+    for part in parts:
+        forward.merge(QuantileSketch().add_all(part))
+    backward = QuantileSketch()
+    for part in reversed(parts):
+        backward.merge(QuantileSketch().add_all(part))
+    whole = QuantileSketch().add_all(values)
+    if not (forward.median() == backward.median() == whole.median()
+            and forward.quantile(0.99) == backward.quantile(0.99) == whole.quantile(0.99)
+            and forward.count == backward.count == whole.count):
+        print("FAILED: merged sketches differ")
+
+    exact_merged = ExactSummary()
+    for part in reversed(parts):
+        exact_merged.merge(ExactSummary(part))
+    if results(exact_merged) != results(ExactSummary(values)):
+        print("FAILED: merged exact summaries differ")
@@ -1,8 +1,80 @@
-from dataclasses import dataclass
+from array import array
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+
+from utils.constants import TrainingDataColId
+
+TIME_COLUMNS = [col for col in TrainingDataColId if not col.is_bool()]
+BOOL_COLUMNS = [col for col in TrainingDataColId if col.is_bool()]
+
+
+class TrainingElements(Sequence):
+    """
+    The training samples as one typed array per column: array('Q') for each time column, and a single array('B')
+    for the bool columns, with one bit per column (bit i is BOOL_COLUMNS[i]).
+    A sample takes 7 * 8 + 1 bytes, instead of a tuple with its ints.
+
+    Indexing and iterating returns the samples as tuples in the order of TrainingDataColId, like the list
+    of tuples this replaces.
+    """
+    def __init__(self, rows=()):
+        self.times = {col: array('Q') for col in TIME_COLUMNS}
+        self.flags = array('B')
+        self.extend(rows)
+
+    def append(self, row):
+        for col, column in self.times.items():
+            column.append(row[col.value])
+
+        flags = 0
+        for bit, col in enumerate(BOOL_COLUMNS):
+            if row[col.value]:
+                flags |= 1 << bit
+        self.flags.append(flags)
+
+    def extend(self, rows):
+        if isinstance(rows, TrainingElements):
+            for col, column in self.times.items():
+                column.extend(rows.times[col])
+            self.flags.extend(rows.flags)
+        else:
+            for row in rows:
+                self.append(row)
+
+    def column(self, col: TrainingDataColId):
+        """
+        The values of one column (an array for time columns, bools for the bool columns).
+        """
+        if col.is_bool():
+            mask = 1 << BOOL_COLUMNS.index(col)
+            return [bool(flags & mask) for flags in self.flags]
+        return self.times[col]
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self._row(self.flags[i], (self.times[col][i] for col in TIME_COLUMNS))
+
+    def __iter__(self):
+        for flags, *times in zip(self.flags, *self.times.values()):
+            yield self._row(flags, times)
+
+    @staticmethod
+    def _row(flags, times) -> tuple:
+        row = [None] * len(TrainingDataColId)
+        for col, t in zip(TIME_COLUMNS, times):
+            row[col.value] = t
+        for bit, col in enumerate(BOOL_COLUMNS):
+            row[col.value] = bool(flags & (1 << bit))
+        return tuple(row)
+
 
 @dataclass
 class TrainingData:
-    elements: list
+    elements: TrainingElements = field(default_factory=TrainingElements)
     mod_count: int = 0
     non_mod_count: int = 0
     mod_wrap_count: int = 0  # 567537
@@ -11,10 +83,25 @@ class TrainingData:
     non_mod_overlap_count: int = 0  # 12282948
     mod_triple_down_count: int = 0
     non_mod_triple_down_count: int = 0
+    # samples that were taken out of elements (see take_elements), but are still counted
+    num_taken: int = 0
+
+    def __post_init__(self):
+        if not isinstance(self.elements, TrainingElements):
+            self.elements = TrainingElements(self.elements)
 
     @property
     def count(self):
-        return len(self.elements)
+        return self.num_taken + len(self.elements)
+
+    def take_elements(self) -> TrainingElements:
+        """
+        Removes and returns the samples (e.g. to write them), while count and the other counters still include them.
+        """
+        elements = self.elements
+        self.elements = TrainingElements()
+        self.num_taken += len(elements)
+        return elements
 
     def add_count(self, is_mod, is_wrapped, is_triple_down):
         if is_mod:
@@ -35,3 +122,16 @@ class TrainingData:
 
             if is_triple_down:
                 self.non_mod_triple_down_count += 1
+
+    def merge(self, other: 'TrainingData'):
+        self.elements.extend(other.elements)
+        self.num_taken += other.num_taken
+        self.mod_count += other.mod_count
+        self.non_mod_count += other.non_mod_count
+        self.mod_wrap_count += other.mod_wrap_count
+        self.non_mod_wrap_count += other.non_mod_wrap_count
+        self.mod_overlap_count += other.mod_overlap_count
+        self.non_mod_overlap_count += other.non_mod_overlap_count
+        self.mod_triple_down_count += other.mod_triple_down_count
+        self.non_mod_triple_down_count += other.non_mod_triple_down_count
+        return self